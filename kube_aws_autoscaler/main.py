@@ -1,25 +1,40 @@
 #!/usr/bin/env python3
 
 import argparse
+import cProfile
 import collections
+import datetime
+import functools
+import hashlib
+import io
 import itertools
+import json
 import logging
 import math
 import os
+import pstats
 import re
+import socket
+import sqlite3
+import tempfile
 import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fractions import Fraction
 
-import boto3
-import pykube
-
-from flask import Flask, jsonify
 from threading import Thread
 
-app = Flask(__name__)
+# boto3, pykube and Flask are imported on first use to keep the startup fast
+
 Healthy = True
+# Flask app serving the health check and decision endpoints, see get_app()
+APP = None
 
 FACTORS = {
-    'm': 1 / 1000,
+    'n': Fraction(1, 1000**3),
+    'u': Fraction(1, 1000**2),
+    'm': Fraction(1, 1000),
+    'k': 1000,
     'K': 1000,
     'M': 1000**2,
     'G': 1000**3,
@@ -34,9 +49,13 @@ FACTORS = {
     'Ei': 1024**6
 }
 
-RESOURCE_PATTERN = re.compile('^(\d*)(\D*)$')
+# Kubernetes quantity: signed decimal number followed by a binary/decimal SI suffix or a decimal exponent
+QUANTITY_PATTERN = re.compile(r'^([+-]?(?:\d+\.?\d*|\.\d+))(?:[eE]([+-]?\d+)|(Ki|Mi|Gi|Ti|Pi|Ei|[numkKMGTPE]))?$')
+QUANTITY_CACHE_SIZE = 4096
 
 RESOURCES = ['cpu', 'memory', 'pods']
+# extended resources (e.g. "nvidia.com/gpu") are formatted as plain numbers, these as bytes
+BYTE_RESOURCE_PREFIXES = ('memory', 'ephemeral-storage', 'hugepages-')
 DEFAULT_CONTAINER_REQUESTS = {'cpu': '10m', 'memory': '50Mi'}
 DEFAULT_BUFFER_PERCENTAGE = {'cpu': 10, 'memory': 10, 'pods': 10}
 DEFAULT_BUFFER_FIXED = {'cpu': '200m', 'memory': '200Mi', 'pods': '10'}
@@ -44,17 +63,104 @@ DEFAULT_BUFFER_FIXED = {'cpu': '200m', 'memory': '200Mi', 'pods': '10'}
 # DescribeAutoScalingInstances operation: The number of instance ids that may be passed in is limited to 50
 DESCRIBE_AUTO_SCALING_INSTANCES_LIMIT = 50
 
+DEFAULT_DRAIN_TIMEOUT = 120
+DRAIN_POLL_INTERVAL = 5
+# policy/v1 Eviction requires Kubernetes 1.22+, older API servers reject it as bad request
+EVICTION_API_VERSIONS = ('policy/v1', 'policy/v1beta1')
+
+SHARD_LEASE_LABEL = 'kube-aws-autoscaler/shard'
+LEASE_API_VERSION = 'coordination.k8s.io/v1'
+LEASE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# low priority pods reserving the buffer, they are preempted as soon as real pods need the room
+PLACEHOLDER_LABEL = 'kube-aws-autoscaler/placeholder'
+PLACEHOLDER_ASG_ANNOTATION = 'kube-aws-autoscaler/asg'
+PLACEHOLDER_ZONE_ANNOTATION = 'kube-aws-autoscaler/zone'
+PLACEHOLDER_PRIORITY_CLASS = 'kube-aws-autoscaler-placeholder'
+PLACEHOLDER_PRIORITY = -10
+PLACEHOLDER_IMAGE = 'registry.k8s.io/pause:3.9'
+PRIORITY_CLASS_API_VERSION = 'scheduling.k8s.io/v1'
+# a single placeholder pod requests at most this share of the weakest node (leaving room for DaemonSets)
+PLACEHOLDER_MAX_NODE_SHARE = 0.5
+# requests are rounded up to not replace the placeholders for every small change of the buffer
+PLACEHOLDER_REQUEST_STEPS = {'cpu': 100, 'memory': 128 * 1024 * 1024}
+
+# size warm pools for the largest scale-up seen in this time window
+WARM_POOL_HISTORY_SECONDS = 3600
+# ASGs without a warm pool only get one if they have this tag
+WARM_POOL_TAG = 'kube-aws-autoscaler/warm-pool'
+# ASG instances in these states are not part of any scaling activity
+STABLE_LIFECYCLE_STATES = frozenset(['InService', 'Standby'])
+# ASG instances in these states are expected to register as nodes soon
+LAUNCHING_LIFECYCLE_STATES = frozenset(['Pending', 'Pending:Wait', 'Pending:Proceed', 'InService'])
+DEFAULT_JOIN_TIMEOUT = 600
+
 logger = logging.getLogger('autoscaler')
 
 
 STATS = {}
 
+# number of upcoming autoscale() iterations to profile (see --profile and POST /profile)
+PROFILE = {'iterations': 0, 'directory': tempfile.gettempdir()}
+PROFILE_TOP_ENTRIES = 25
+
+# structured records of the last autoscale() decisions, served by GET /decisions
+DECISION_LOG_SIZE = 100
+DECISIONS = collections.deque(maxlen=DECISION_LOG_SIZE)
+
+# time series of the decisions (see --metrics-db and GET /history): samples of every loop are kept for a day,
+# hourly averages afterwards until the row limit is reached
+METRICS = {'path': None, 'connection': None, 'maintained': 0}
+METRICS_RAW_RETENTION = 24 * 3600
+METRICS_DOWNSAMPLE_RESOLUTION = 3600
+METRICS_MAINTENANCE_INTERVAL = 3600
+METRICS_DB_MAX_ROWS = 2000000
+METRICS_QUERY_LIMIT = 10000
+METRICS_COLUMNS = ('timestamp', 'resolution', 'asg_name', 'zone', 'metric', 'value')
+
+# nodes and requested resources per ASG/AZ of the last loop (used for what-if analysis)
+CLUSTER_STATE = {}
+
+# node name => (resourceVersion, parsed node)
+NODE_CACHE = {}
+
+# region => AutoScaling client (clients are thread-safe and reused across loops)
+AUTOSCALING_CLIENTS = {}
+
+# ASG name => (time of the describe call, ASG description)
+ASG_CACHE = {}
 
-def parse_resource(v: str):
-    '''Parse Kubernetes resource string'''
-    match = RESOURCE_PATTERN.match(v)
-    factor = FACTORS.get(match.group(2), 1)
-    return int(match.group(1)) * factor
+# instance type => allocatable resources (the smallest seen on its nodes), used to size ASGs without (suitable) nodes
+INSTANCE_TYPE_ALLOCATABLE = {}
+# ASG name => instance types of its nodes seen so far
+ASG_INSTANCE_TYPES = collections.defaultdict(set)
+
+# ASG name => scale-up which is still waiting for all nodes to become ready
+SCALE_UPS = {}
+# instance ID => launched ASG instance which did not register as node yet
+IN_FLIGHT = {}
+# ASG name => list of (timestamp, number of added instances)
+SCALE_UP_HISTORY = collections.defaultdict(list)
+
+
+@functools.lru_cache(maxsize=QUANTITY_CACHE_SIZE)
+def parse_resource(v: str, resource: str=None) -> int:
+    '''
+    Parse Kubernetes resource quantity string into integer base units (millicores for CPU, bytes for memory),
+    fractions are rounded up like Kubernetes does
+    '''
+    match = QUANTITY_PATTERN.match(v)
+    if not match:
+        raise ValueError('Invalid resource quantity: {}'.format(v))
+    number, exponent, suffix = match.groups()
+    value = Fraction(number)
+    if exponent:
+        value *= Fraction(10) ** int(exponent)
+    elif suffix:
+        value *= FACTORS[suffix]
+    if resource == 'cpu':
+        value *= 1000
+    return math.ceil(value)
 
 
 def get_node_allocatable_tuple(node: dict):
@@ -69,10 +175,57 @@ def apply_buffer(requested: dict, buffer_percentage: dict, buffer_fixed: dict):
     return requested_with_buffer
 
 
+def get_required_nodes(requested: dict, allocatable: dict):
+    '''
+    Return the number of nodes with the given allocatable resources needed to fit the requested resources
+
+    Resources the node does not provide at all (e.g. GPUs requested by pending pods) are ignored.
+    '''
+    required_nodes = 0
+    for resource, value in requested.items():
+        cap = allocatable.get(resource, 0)
+        if value > 0 and cap > 0:
+            nodes = int(math.ceil(value / cap))
+            # guard against float rounding, i.e. make sure the nodes are really sufficient
+            while nodes * cap < value:
+                nodes += 1
+            required_nodes = max(required_nodes, nodes)
+    return required_nodes
+
+
+def get_extended_resources(resources: dict):
+    return set(resource for resource, value in resources.items() if resource not in RESOURCES and value)
+
+
+def get_zone_resources(requested: dict, weakest_node: dict):
+    '''
+    Return the resources to consider for an ASG/AZ: the standard ones plus any extended resources
+    (e.g. "ephemeral-storage" or "nvidia.com/gpu") which are requested and provided by its nodes
+    '''
+    extended = [resource for resource in requested
+                if resource not in RESOURCES and weakest_node['allocatable'].get(resource)]
+    return RESOURCES + sorted(extended)
+
+
 def find_weakest_node(nodes):
     return sorted(nodes, key=get_node_allocatable_tuple)[0]
 
 
+def get_weakest_allocatable(nodes: list):
+    '''
+    Return the minimum allocatable amount per resource of the given nodes
+
+    Extended resources count if any node provides them (e.g. a new GPU node might not have registered its GPUs yet),
+    the minimum is taken over the nodes providing them.
+    '''
+    allocatable = {resource: min(node['allocatable'].get(resource, 0) for node in nodes) for resource in RESOURCES}
+    for node in nodes:
+        for resource, value in node['allocatable'].items():
+            if resource not in RESOURCES and value:
+                allocatable[resource] = min(allocatable.get(resource, value), value)
+    return allocatable
+
+
 def is_sufficient(requested: dict, allocatable: dict):
     for resource, cap in allocatable.items():
         if requested.get(resource, 0) > cap:
@@ -80,6 +233,30 @@ def is_sufficient(requested: dict, allocatable: dict):
     return True
 
 
+def get_node_utilization(node: dict):
+    '''
+    Return the highest ratio of requested to allocatable resources of the given node (0.0 = empty)
+    '''
+    requested = node.get('requested', {})
+    utilization = 0.
+    for resource, cap in node['allocatable'].items():
+        if cap:
+            utilization = max(utilization, requested.get(resource, 0) / cap)
+    return utilization
+
+
+def find_least_utilized_nodes(nodes: list):
+    '''
+    Return all nodes eligible for termination, sorted by number of pods to evict and utilization
+
+    Nodes which are already cordoned (e.g. by an operator) are left alone.
+    '''
+    eligible = [node for node in nodes
+                if node['ready'] and not node['master'] and not node.get('unschedulable')
+                and node.get('asg_lifecycle_state') == 'InService']
+    return sorted(eligible, key=lambda node: (node.get('requested', {}).get('pods', 0), get_node_utilization(node)))
+
+
 def is_node_ready(node):
     '''
     Return whether the given pykube Node has "Ready" status
@@ -90,33 +267,52 @@ def is_node_ready(node):
     return False
 
 
+def parse_node(node) -> dict:
+    region = node.labels['failure-domain.beta.kubernetes.io/region']
+    zone = node.labels['failure-domain.beta.kubernetes.io/zone']
+    instance_type = node.labels['beta.kubernetes.io/instance-type']
+    allocatable = {}
+    # Use the Node Allocatable Resources to account for any kube/system reservations:
+    # https://github.com/kubernetes/community/blob/master/contributors/design-proposals/node-allocatable.md
+    for key, val in node.obj['status']['allocatable'].items():
+        allocatable[key] = parse_resource(val, key)
+
+    instance_id = ""
+
+    if int(node.obj['status']['nodeInfo']['kubeletVersion'].split(".")[1]) < 11:
+        instance_id = node.obj['spec']['externalID']
+    else:
+        instance_id = node.obj['spec']['providerID'].split("/")[4]
+
+    return {'name': node.name,
+            'region': region, 'zone': zone, 'instance_id': instance_id, 'instance_type': instance_type,
+            'allocatable': allocatable,
+            'ready': is_node_ready(node),
+            'unschedulable': node.obj['spec'].get('unschedulable', False),
+            'master': node.labels.get('master', 'false') == 'true'}
+
+
 def get_nodes(api, include_master_nodes: bool=False) -> dict:
+    import pykube
+
     nodes = {}
+    seen = set()
     for node in pykube.Node.objects(api):
-        region = node.labels['failure-domain.beta.kubernetes.io/region']
-        zone = node.labels['failure-domain.beta.kubernetes.io/zone']
-        instance_type = node.labels['beta.kubernetes.io/instance-type']
-        allocatable = {}
-        # Use the Node Allocatable Resources to account for any kube/system reservations:
-        # https://github.com/kubernetes/community/blob/master/contributors/design-proposals/node-allocatable.md
-        for key, val in node.obj['status']['allocatable'].items():
-            allocatable[key] = parse_resource(val)
-
-        instance_id = ""
-
-        if int(node.obj['status']['nodeInfo']['kubeletVersion'].split(".")[1]) < 11:
-            instance_id = node.obj['spec']['externalID']
+        seen.add(node.name)
+        # only parse nodes which changed since the last loop
+        resource_version = node.obj.get('metadata', {}).get('resourceVersion')
+        cached = NODE_CACHE.get(node.name)
+        if resource_version and cached and cached[0] == resource_version:
+            obj = cached[1]
         else:
-            instance_id = node.obj['spec']['providerID'].split("/")[4]
-
-        obj = {'name': node.name,
-               'region': region, 'zone': zone, 'instance_id': instance_id, 'instance_type': instance_type,
-               'allocatable': allocatable,
-               'ready': is_node_ready(node),
-               'unschedulable': node.obj['spec'].get('unschedulable', False),
-               'master': node.labels.get('master', 'false') == 'true'}
+            obj = parse_node(node)
+            NODE_CACHE[node.name] = resource_version, obj
         if include_master_nodes or not obj['master']:
-            nodes[node.name] = obj
+            # copy as the node dict is annotated (ASG, requests, ..) during the loop
+            nodes[node.name] = dict(obj)
+    # forget nodes which no longer exist
+    for node_name in set(NODE_CACHE) - seen:
+        del NODE_CACHE[node_name]
     return nodes
 
 
@@ -144,10 +340,18 @@ def get_nodes_by_asg_zone(autoscaling, nodes: dict) -> dict:
     return nodes_by_asg_zone
 
 
-def calculate_usage_by_asg_zone(pods: list, nodes: dict) -> dict:
+def calculate_usage_by_asg_zone(pods: list, nodes: dict, pending_requests: list=None) -> dict:
+    '''
+    Return the requested resources per ASG/AZ, pending pods are counted as ("unknown", "unknown")
+
+    The requests of every pending pod are appended to the given pending_requests list (if any).
+    '''
     usage_by_asg_zone = {}
 
     for pod in pods:
+        if pod.obj.get('metadata', {}).get('labels', {}).get(PLACEHOLDER_LABEL):
+            # our own placeholders do not count as demand
+            continue
         phase = pod.obj['status'].get('phase')
         if phase == 'Succeeded':
             # ignore completed jobs
@@ -161,6 +365,8 @@ def calculate_usage_by_asg_zone(pods: list, nodes: dict) -> dict:
         if node:
             asg_name = node['asg_name']
             zone = node['zone']
+            # remember the requests per node to find the least utilized node when scaling down
+            node['requested'] = node.get('requested') or {resource: 0 for resource in RESOURCES}
         else:
             if node_name and phase in ('Running', 'Unknown'):
                 # ignore killed "ghost" pods
@@ -181,26 +387,132 @@ def calculate_usage_by_asg_zone(pods: list, nodes: dict) -> dict:
                         logger.debug('Container {}/{} has no resource request for {}'.format(
                                      pod.name, container['name'], resource))
                         value = DEFAULT_CONTAINER_REQUESTS[resource]
-                    requests[resource] += parse_resource(value)
+                    requests[resource] += parse_resource(value, resource)
+            for resource, value in container_requests.items():
+                if resource not in RESOURCES:
+                    # extended resources have no default request
+                    requests[resource] += parse_resource(value, resource)
         key = asg_name, zone
         if key not in usage_by_asg_zone:
             usage_by_asg_zone[key] = {resource: 0 for resource in RESOURCES}
-        for resource in usage_by_asg_zone[key]:
-            usage_by_asg_zone[key][resource] += requests.get(resource, 0)
+        for resource, value in requests.items():
+            usage_by_asg_zone[key][resource] = usage_by_asg_zone[key].get(resource, 0) + value
+        if node:
+            for resource, value in requests.items():
+                node['requested'][resource] = node['requested'].get(resource, 0) + value
+        elif pending_requests is not None:
+            pending_requests.append(dict(requests))
     return usage_by_asg_zone
 
 
 def format_resource(value: float, resource: str):
     if resource == 'cpu':
-        return '{:.1f}'.format(value)
-    elif resource == 'memory':
+        return '{:.1f}'.format(value / 1000)
+    elif resource.startswith(BYTE_RESOURCE_PREFIXES):
         return '{:.0f}Mi'.format(value / (1024*1024))
     elif resource == 'pods':
         return '{:.0f}'.format(value)
     return '{:.0f}'.format(value)
 
 
-def slow_down_downscale(asg_sizes: dict, nodes_by_asg_zone: dict, scale_down_step_fixed: int, scale_down_step_percentage: float):
+def get_asg_decision(decision: dict, asg_name: str):
+    '''
+    Return the decision record of the given ASG (or a throwaway dict if no decision is recorded)
+    '''
+    if decision is None:
+        return {}
+    return decision['asgs'].setdefault(asg_name, {})
+
+
+def format_zone_decision(record: dict):
+    '''
+    Return the decision record of an ASG/AZ as human readable table lines
+    '''
+    asg_name, zone, resources = record['asg_name'], record['zone'], record['resources']
+
+    def row(label, values):
+        return '{}/{}: {} {}'.format(asg_name, zone, label.ljust(14),
+                                     ' '.join([format_resource(values.get(r, 0), r).rjust(10) for r in resources]))
+
+    lines = ['{}/{}:                {}'.format(asg_name, zone, ' '.join([r.rjust(10).upper() for r in resources])),
+             row('requested:', record['requested']),
+             row('with buffer:', record['with_buffer']),
+             row('weakest node:', record['weakest_node']),
+             row('overprovision:', record['overprovisioned']),
+             '{}/{}: => {} nodes required (current: {})'.format(asg_name, zone, record['required_nodes'], record['current_nodes'])]
+    if record.get('scale_down_disabled'):
+        lines.append('{}/{}: scaling down is not allowed, forcing {} nodes'.format(asg_name, zone, record['current_nodes']))
+    return lines
+
+
+def get_metrics_db(path: str):
+    if METRICS['path'] != path:
+        connection = sqlite3.connect(path)
+        # readers (GET /history) do not block the writer and vice versa
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS samples (timestamp INTEGER NOT NULL, resolution INTEGER NOT NULL, '
+                           'asg_name TEXT NOT NULL, zone TEXT NOT NULL, metric TEXT NOT NULL, value REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS samples_by_metric ON samples (metric, asg_name, zone, timestamp)')
+        METRICS.update(path=path, connection=connection, maintained=0)
+    return METRICS['connection']
+
+
+def get_decision_metrics(decision: dict):
+    '''
+    Return the metric rows (see METRICS_COLUMNS) of the given decision record
+    '''
+    timestamp = int(decision['timestamp'])
+    rows = []
+    for record in decision['zones']:
+        key = (timestamp, 0, record['asg_name'], record['zone'])
+        for resource in record['resources']:
+            rows.append(key + ('requested.' + resource, record['requested'].get(resource, 0)))
+            rows.append(key + ('with_buffer.' + resource, record['with_buffer'].get(resource, 0)))
+        rows.append(key + ('required_nodes', record['required_nodes']))
+        rows.append(key + ('current_nodes', record['current_nodes']))
+    for asg_name, asg_decision in sorted(decision['asgs'].items()):
+        # ASG level metrics have no zone
+        for metric, field in (('required_capacity', 'required'), ('desired_capacity', 'new'), ('in_flight', 'in_flight')):
+            if field in asg_decision:
+                rows.append((timestamp, 0, asg_name, '', metric, asg_decision[field]))
+    return rows
+
+
+def downsample_metrics(connection, now: float):
+    '''
+    Replace samples older than METRICS_RAW_RETENTION by hourly averages and drop the oldest rows above METRICS_DB_MAX_ROWS
+    '''
+    resolution = METRICS_DOWNSAMPLE_RESOLUTION
+    cutoff = int(now - METRICS_RAW_RETENTION) // resolution * resolution
+    with connection:
+        connection.execute('INSERT INTO samples SELECT timestamp / :resolution * :resolution, :resolution, asg_name, zone, metric, AVG(value) '
+                           'FROM samples WHERE resolution = 0 AND timestamp < :cutoff '
+                           'GROUP BY timestamp / :resolution, asg_name, zone, metric', {'resolution': resolution, 'cutoff': cutoff})
+        connection.execute('DELETE FROM samples WHERE resolution = 0 AND timestamp < ?', (cutoff, ))
+        count = connection.execute('SELECT COUNT(*) FROM samples').fetchone()[0]
+        if count > METRICS_DB_MAX_ROWS:
+            connection.execute('DELETE FROM samples WHERE rowid IN (SELECT rowid FROM samples ORDER BY timestamp LIMIT ?)',
+                               (count - METRICS_DB_MAX_ROWS, ))
+
+
+def record_metrics(path: str, decision: dict):
+    '''
+    Append the metrics of the given decision record to the SQLite database (one transaction per loop)
+    '''
+    connection = get_metrics_db(path)
+    with connection:
+        connection.executemany('INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?)', get_decision_metrics(decision))
+    if decision['timestamp'] - METRICS['maintained'] >= METRICS_MAINTENANCE_INTERVAL:
+        downsample_metrics(connection, decision['timestamp'])
+        METRICS['maintained'] = decision['timestamp']
+
+
+def slow_down_downscale(asg_sizes: dict, nodes_by_asg_zone: dict, scale_down_step_fixed: int, scale_down_step_percentage: float,
+                        decision: dict=None, in_flight_by_asg: dict=None, quiet: bool=False):
+    '''
+    Limit the scale-down of every ASG to the configured step (quiet: do not log, e.g. for what-if analysis)
+    '''
     # validate scale-down-step-fixed, must be >= 1
     if scale_down_step_fixed < 1:
         raise ValueError('scale-down-step-fixed must be >= 1')
@@ -210,94 +522,298 @@ def slow_down_downscale(asg_sizes: dict, nodes_by_asg_zone: dict, scale_down_ste
         raise ValueError('scale-down-step-precentage value must be: 0 < value <= 1')
 
     node_counts_by_asg = collections.defaultdict(int)
+    node_weights_by_asg = collections.defaultdict(lambda: 1)
     for key, nodes in sorted(nodes_by_asg_zone.items()):
         asg_name, zone = key
-        node_counts_by_asg[asg_name] += len(nodes)
+        node_counts_by_asg[asg_name] += get_capacity_units(nodes)
+        for node in nodes:
+            node_weights_by_asg[asg_name] = max(node_weights_by_asg[asg_name], node.get('capacity_units', 1))
 
     for asg_name, desired_size in sorted(asg_sizes.items()):
-        current_size = node_counts_by_asg[asg_name]
+        # instances which are still joining the cluster count as existing capacity
+        current_size = node_counts_by_asg[asg_name] + (in_flight_by_asg or {}).get(asg_name, 0)
+        # the scale-down step is in whole nodes (of the largest weight for mixed instances ASGs)
+        weight = node_weights_by_asg[asg_name]
         amount_of_downscale = current_size - desired_size
-        if amount_of_downscale >= 2:
-            new_desired_size_fixed = current_size - scale_down_step_fixed
+        if amount_of_downscale >= 2 or (weight > 1 and amount_of_downscale > 0):
+            new_desired_size_fixed = current_size - scale_down_step_fixed * weight
             new_desired_size_percentage = max(desired_size, int(math.ceil((1.00 - scale_down_step_percentage) * current_size)))
             if new_desired_size_percentage >= current_size:
                 # percentage amount is too small, make sure we downscale by fixed amount at least
                 new_desired_size_percentage = new_desired_size_fixed
             new_desired_size = min(new_desired_size_fixed, new_desired_size_percentage)
-            logger.info('Slowing down downscale: changing desired size of ASG {} (current size is {}) from {} to {}'.format(
-                        asg_name, current_size, desired_size, new_desired_size))
+            if weight > 1:
+                # only whole nodes can be removed (without going below the desired size),
+                # AWS would not terminate an instance exceeding the decrement
+                step_nodes = int(math.ceil((current_size - new_desired_size) / weight))
+                new_desired_size = current_size - min(step_nodes, amount_of_downscale // weight) * weight
+            if not quiet:
+                logger.info('Slowing down downscale: changing desired size of ASG {} (current size is {}) from {} to {}'.format(
+                            asg_name, current_size, desired_size, new_desired_size))
+            get_asg_decision(decision, asg_name)['slowed_down'] = {'from': desired_size, 'to': new_desired_size}
             asg_sizes[asg_name] = new_desired_size
 
     return asg_sizes
 
 
-def calculate_required_auto_scaling_group_sizes(nodes_by_asg_zone: dict, usage_by_asg_zone: dict,
-                                                buffer_percentage: dict, buffer_fixed: dict,
-                                                buffer_spare_nodes: int=0, disable_scale_down: bool=False):
-    asg_size = collections.defaultdict(int)
+def get_capacity_units(nodes: list):
+    '''
+    Return the ASG capacity the given nodes count for (their instance type's weight, one per node by default)
+    '''
+    return sum(node.get('capacity_units', 1) for node in nodes)
 
-    dump_info = STATS.get('last_info_dump', 0) < (time.time() - 600)
 
+def learn_instance_types(nodes_by_asg_zone: dict):
+    for (asg_name, _), nodes in nodes_by_asg_zone.items():
+        for node in nodes:
+            ASG_INSTANCE_TYPES[asg_name].add(node['instance_type'])
+            known = INSTANCE_TYPE_ALLOCATABLE.get(node['instance_type'])
+            INSTANCE_TYPE_ALLOCATABLE[node['instance_type']] = (get_weakest_allocatable([{'allocatable': known}, node]) if known
+                                                                else dict(node['allocatable']))
+
+
+def get_asg_capacity(asg: dict, spot_capacity_factor: float=1.0):
+    '''
+    Return the capacity model of the given ASG description
+
+    The instance types and their weights come from the MixedInstancesPolicy overrides (or from the nodes seen so far),
+    the allocatable resources of one capacity unit are the ones of the weakest known instance type per unit
+    (None if no instance type is known). Spot capacity only counts with the given factor.
+    '''
+    policy = asg.get('MixedInstancesPolicy')
+    weights = {}
+    spot_share = 0
+    if policy:
+        for override in policy.get('LaunchTemplate', {}).get('Overrides', []):
+            if override.get('InstanceType'):
+                weights[override['InstanceType']] = int(override.get('WeightedCapacity') or 1)
+        # the base capacity is ignored, AWS defaults to on-demand instances only
+        on_demand_percentage = policy.get('InstancesDistribution', {}).get('OnDemandPercentageAboveBaseCapacity', 100)
+        spot_share = (100 - on_demand_percentage) / 100
+    if not weights:
+        weights = {instance_type: 1 for instance_type in ASG_INSTANCE_TYPES.get(asg['AutoScalingGroupName'], ())}
+
+    allocatable = None
+    for instance_type, weight in sorted(weights.items()):
+        known = INSTANCE_TYPE_ALLOCATABLE.get(instance_type)
+        if not known:
+            continue
+        per_unit = {resource: value / weight for resource, value in known.items()}
+        if allocatable is None:
+            allocatable = per_unit
+        else:
+            allocatable = {resource: min(value, per_unit[resource]) for resource, value in allocatable.items() if resource in per_unit}
+    if allocatable is not None and spot_share:
+        # spot instances can be interrupted any time
+        factor = 1 - spot_share + spot_share * spot_capacity_factor
+        allocatable = {resource: value * factor for resource, value in allocatable.items()}
+    return {'mixed': bool(policy), 'weights': weights, 'spot_share': spot_share, 'allocatable': allocatable}
+
+
+def get_capacity_model(asgs: dict, nodes_by_asg_zone: dict, spot_capacity_factor: float=1.0):
+    '''
+    Return the capacity model per ASG, set the capacity units of all nodes and add the AZs of ASGs without any node
+    '''
+    learn_instance_types(nodes_by_asg_zone)
+    asgs_with_nodes = set(asg_name for (asg_name, _), nodes in nodes_by_asg_zone.items() if nodes)
+    capacity_by_asg = {}
+    for asg_name, asg in sorted(asgs.items()):
+        capacity = capacity_by_asg[asg_name] = get_asg_capacity(asg, spot_capacity_factor)
+        if asg_name not in asgs_with_nodes:
+            for zone in asg.get('AvailabilityZones', []):
+                nodes_by_asg_zone[asg_name, zone] = []
+        for (name, _), nodes in nodes_by_asg_zone.items():
+            if name == asg_name:
+                for node in nodes:
+                    node['capacity_units'] = capacity['weights'].get(node['instance_type'], 1)
+    return capacity_by_asg
+
+
+def get_servable_pending_requests(pending_requests: list, allocatable: dict, served: list):
+    '''
+    Return the summed requests of the pending pods which an ASG without nodes has to serve: pods requesting only
+    extended resources provided by the given allocatable resources and not provided together by any ASG/AZ with nodes
+    (e.g. CPU-only pods do not start a GPU ASG, they are served by the ASGs with nodes)
+    '''
+    provided = get_extended_resources(allocatable)
+    requested = {resource: 0 for resource in RESOURCES}
+    for requests in pending_requests:
+        extended = get_extended_resources(requests)
+        if extended <= provided and not any(extended <= resources for resources in served):
+            for resource, value in requests.items():
+                requested[resource] = requested.get(resource, 0) + value
+    return requested
+
+
+def get_sizing_inputs(nodes_by_asg_zone: dict, usage_by_asg_zone: dict, capacity_by_asg: dict=None, pending_requests: list=None):
+    '''
+    Return the configuration independent inputs of the sizing calculation for every ASG/AZ
+
+    ASGs with a capacity model (see get_asg_capacity) are sized in capacity units, also if they have no nodes.
+    ASGs without nodes are only sized for the pending pods they have to serve (see get_servable_pending_requests),
+    once per ASG as AWS chooses the AZ of new instances.
+    '''
+    pending = usage_by_asg_zone.get(('unknown', 'unknown'))
+    if pending_requests is None:
+        # only the total is known
+        pending_requests = [pending] if pending else []
+    served = [get_extended_resources(get_weakest_allocatable(nodes)) for nodes in nodes_by_asg_zone.values() if nodes]
+    sized_asgs = set()
+    inputs = []
     for key, nodes in sorted(nodes_by_asg_zone.items()):
         asg_name, zone = key
-        requested = usage_by_asg_zone.get(key) or {resource: 0 for resource in RESOURCES}
-        pending = usage_by_asg_zone.get(('unknown', 'unknown'))
-        if pending:
-            # add requested resources from unassigned/pending pods
-            for resource, val in pending.items():
-                requested[resource] += val
-        requested_with_buffer = apply_buffer(requested, buffer_percentage, buffer_fixed)
-        weakest_node = find_weakest_node(nodes)
-        required_nodes = 0
-        allocatable = {resource: 0 for resource in RESOURCES}
-        while not is_sufficient(requested_with_buffer, allocatable):
-            for resource in allocatable:
-                allocatable[resource] += weakest_node['allocatable'][resource]
-            required_nodes += 1
+        capacity = (capacity_by_asg or {}).get(asg_name) or {}
+        if capacity.get('allocatable') and (capacity['mixed'] or not nodes):
+            weakest_node = {'allocatable': capacity['allocatable']}
+        elif nodes:
+            weakest_node = {'allocatable': get_weakest_allocatable(nodes)}
+        else:
+            logger.warning('Instance types of ASG {} are unknown, cannot size {} without any node'.format(asg_name, zone))
+            continue
+
+        if nodes:
+            requested = dict(usage_by_asg_zone.get(key) or {resource: 0 for resource in RESOURCES})
+            if pending:
+                # add requested resources from unassigned/pending pods
+                for resource, val in pending.items():
+                    requested[resource] = requested.get(resource, 0) + val
+        elif asg_name in sized_asgs:
+            requested = {resource: 0 for resource in RESOURCES}
+        else:
+            requested = get_servable_pending_requests(pending_requests, weakest_node['allocatable'], served)
+            sized_asgs.add(asg_name)
 
+        compensated_nodes = []
         for node in nodes:
             # compensate any manually cordoned nodes (e.g. by kubectl drain)
             # but only if they are "in service", i.e. not being terminated by ASG right now
             if node['unschedulable'] and not node['master'] and node['asg_lifecycle_state'] == 'InService':
-                logger.info('Node {} is marked as unschedulable, compensating.'.format(node['name']))
-                required_nodes += 1
+                logger.debug('Node {} is marked as unschedulable, compensating.'.format(node['name']))
+                compensated_nodes.append(node)
+
+        # a spare node counts with the largest weight of the zone's nodes (or of the ASG's instance types)
+        node_units = max([node.get('capacity_units', 1) for node in nodes] or list(capacity.get('weights', {}).values()) or [1])
+        inputs.append({'asg_name': asg_name, 'zone': zone, 'resources': get_zone_resources(requested, weakest_node),
+                       'requested': requested, 'weakest_node': weakest_node['allocatable'],
+                       'compensated_nodes': [node['name'] for node in compensated_nodes],
+                       'compensated_units': get_capacity_units(compensated_nodes), 'node_units': node_units,
+                       'current_nodes': get_capacity_units(nodes)})
+    return inputs
 
-        required_nodes += buffer_spare_nodes
 
-        overprovisioned = {resource: 0 for resource in RESOURCES}
-        for resource, value in allocatable.items():
-            overprovisioned[resource] = value - requested[resource]
+def calculate_zone_size(inputs: dict, buffer_percentage: dict, buffer_fixed: dict,
+                        buffer_spare_nodes: int=0, disable_scale_down: bool=False):
+    '''
+    Return the decision record (inputs plus buffer, overprovisioning and required nodes) of an ASG/AZ
+    '''
+    requested, weakest_node, resources = inputs['requested'], inputs['weakest_node'], inputs['resources']
+    if not inputs['current_nodes'] and not any(requested.values()):
+        # keep AZs without nodes and without pending demand at zero (i.e. ASGs with MinSize 0 can stay empty)
+        buffer_fixed = {}
+        buffer_spare_nodes = 0
+    requested_with_buffer = apply_buffer(requested, buffer_percentage, buffer_fixed)
+    required_nodes = get_required_nodes({r: requested_with_buffer.get(r, 0) for r in resources}, weakest_node)
 
+    overprovisioned = {}
+    for resource in resources:
+        overprovisioned[resource] = weakest_node.get(resource, 0) * required_nodes - requested.get(resource, 0)
+
+    # both in capacity units
+    required_nodes += inputs['compensated_units']
+    required_nodes += buffer_spare_nodes * inputs['node_units']
+
+    record = dict(inputs, with_buffer=requested_with_buffer, overprovisioned=overprovisioned,
+                  spare_nodes=buffer_spare_nodes, required_nodes=required_nodes)
+    if disable_scale_down:
+        record['scale_down_disabled'] = inputs['current_nodes'] > required_nodes
+    return record
+
+
+def calculate_required_auto_scaling_group_sizes(nodes_by_asg_zone: dict, usage_by_asg_zone: dict,
+                                                buffer_percentage: dict, buffer_fixed: dict,
+                                                buffer_spare_nodes: int=0, disable_scale_down: bool=False,
+                                                decision: dict=None, capacity_by_asg: dict=None, pending_requests: list=None):
+    asg_size = collections.defaultdict(int)
+
+    dump_info = STATS.get('last_info_dump', 0) < (time.time() - 600)
+
+    for inputs in get_sizing_inputs(nodes_by_asg_zone, usage_by_asg_zone, capacity_by_asg, pending_requests):
+        record = calculate_zone_size(inputs, buffer_percentage, buffer_fixed, buffer_spare_nodes, disable_scale_down)
+
+        if decision is not None:
+            decision['zones'].append(record)
         if dump_info:
-            logger.info('{}/{}:                {}'.format(asg_name, zone,
-                        ' '.join([r.rjust(10).upper() for r in RESOURCES])))
-            logger.info('{}/{}: requested:     {}'.format(asg_name, zone,
-                        ' '.join([format_resource(requested[r], r).rjust(10) for r in RESOURCES])))
-            logger.info('{}/{}: with buffer:   {}'.format(asg_name, zone,
-                        ' '.join([format_resource(requested_with_buffer[r], r).rjust(10) for r in RESOURCES])))
-            logger.info('{}/{}: weakest node:  {}'.format(asg_name, zone,
-                        ' '.join([format_resource(weakest_node['allocatable'][r], r).rjust(10) for r in RESOURCES])))
-            logger.info('{}/{}: overprovision: {}'.format(asg_name, zone,
-                        ' '.join([format_resource(overprovisioned[r], r).rjust(10) for r in RESOURCES])))
-            logger.info('{}/{}: => {} nodes required (current: {})'.format(asg_name, zone, required_nodes, len(nodes)))
+            for line in format_zone_decision(record):
+                logger.info(line)
             STATS['last_info_dump'] = time.time()
 
+        required_nodes = record['required_nodes']
         if disable_scale_down:
-            current_nodes = len(nodes)
-            if dump_info and current_nodes > required_nodes:
-                logger.info('{}/{}: scaling down is not allowed, forcing {} nodes'.format(asg_name, zone, current_nodes))
-            required_nodes = max(required_nodes, current_nodes)
-
-        asg_size[asg_name] += required_nodes
+            required_nodes = max(required_nodes, record['current_nodes'])
+        asg_size[record['asg_name']] += required_nodes
 
     return asg_size
 
 
+def get_what_if_config(config: dict):
+    '''
+    Return the sizing parameters of a what-if configuration (keys are the command line option names),
+    unspecified options fall back to their defaults
+    '''
+    buffer_percentage = {}
+    buffer_fixed = {}
+    for resource in RESOURCES:
+        buffer_percentage[resource] = float(config.get('buffer-{}-percentage'.format(resource), DEFAULT_BUFFER_PERCENTAGE[resource]))
+        buffer_fixed[resource] = parse_resource(str(config.get('buffer-{}-fixed'.format(resource), DEFAULT_BUFFER_FIXED[resource])),
+                                                resource)
+    return {'buffer_percentage': buffer_percentage, 'buffer_fixed': buffer_fixed,
+            'buffer_spare_nodes': int(config.get('buffer-spare-nodes', 1)),
+            'disable_scale_down': bool(config.get('no-scale-down', False)),
+            'scale_down_step_fixed': int(config.get('scale-down-step-fixed', 1)),
+            'scale_down_step_percentage': float(config.get('scale-down-step-percentage', 0.0))}
+
+
+def evaluate_what_if(nodes_by_asg_zone: dict, usage_by_asg_zone: dict, configs: list, capacity_by_asg: dict=None,
+                     pending_requests: list=None):
+    '''
+    Return the resulting ASG sizes and overprovisioning for each of the given configurations
+
+    The configuration independent inputs are only computed once for all configurations.
+    '''
+    inputs = get_sizing_inputs(nodes_by_asg_zone, usage_by_asg_zone, capacity_by_asg, pending_requests)
+    results = []
+    for config in configs:
+        params = get_what_if_config(config)
+        asg_size = collections.defaultdict(int)
+        overprovisioned = {}
+        for zone_inputs in inputs:
+            record = calculate_zone_size(zone_inputs, params['buffer_percentage'], params['buffer_fixed'],
+                                         params['buffer_spare_nodes'], params['disable_scale_down'])
+            required_nodes = record['required_nodes']
+            if params['disable_scale_down']:
+                required_nodes = max(required_nodes, record['current_nodes'])
+            asg_size[record['asg_name']] += required_nodes
+            overprovisioned['{}/{}'.format(record['asg_name'], record['zone'])] = record['overprovisioned']
+        asg_size = slow_down_downscale(dict(asg_size), nodes_by_asg_zone,
+                                       params['scale_down_step_fixed'], params['scale_down_step_percentage'], quiet=True)
+        results.append({'config': config, 'asg_sizes': asg_size, 'overprovisioned': overprovisioned})
+    return results
+
+
 def scaling_activity_in_progress(autoscaling, asg_name: str):
     '''
     Return True if the given Auto Scaling Group currently has some activity in progress
     (e.g. replacing an instance, waiting for ELB draining or waiting for instance shut down)
     '''
+    cached = ASG_CACHE.get(asg_name)
+    if cached and 'Instances' in cached[1]:
+        # derive the activity from the cached ASG description instead of describing its activities
+        # (the desired capacity is in capacity units, weighted instances may overshoot it)
+        asg = cached[1]
+        in_service = sum(int(instance.get('WeightedCapacity') or 1) for instance in asg['Instances']
+                         if instance['LifecycleState'] == 'InService')
+        return (in_service < asg['DesiredCapacity'] or
+                any(instance['LifecycleState'] not in STABLE_LIFECYCLE_STATES for instance in asg['Instances']))
     result = autoscaling.describe_scaling_activities(AutoScalingGroupName=asg_name, MaxRecords=20)
     for activity in result['Activities']:
         # "Progress" is a % value between 0 and 100 that indicates the progress of the activity.
@@ -306,36 +822,346 @@ def scaling_activity_in_progress(autoscaling, asg_name: str):
     return False
 
 
-def resize_auto_scaling_groups(autoscaling, asg_size: dict, ready_nodes_by_asg: dict, dry_run: bool=False):
+def record_scale_up(asg_name: str, current_capacity: int, desired_capacity: int):
+    now = time.time()
+    SCALE_UPS[asg_name] = {'started': now, 'from': current_capacity, 'to': desired_capacity}
+    history = SCALE_UP_HISTORY[asg_name]
+    history.append((now, desired_capacity - current_capacity))
+    while history[0][0] < now - WARM_POOL_HISTORY_SECONDS:
+        history.pop(0)
+
+
+def report_scale_up_readiness(ready_nodes_by_asg: dict):
+    '''
+    Log the time it took for all nodes of a previous scale-up to become ready
+    '''
+    for asg_name, scale_up in sorted(SCALE_UPS.items()):
+        if ready_nodes_by_asg.get(asg_name, 0) >= scale_up['to']:
+            duration = time.time() - scale_up['started']
+            logger.info('Scale-up of ASG {} from {} to {} took {:.0f}s until all nodes were ready'.format(
+                        asg_name, scale_up['from'], scale_up['to'], duration))
+            STATS.setdefault('time_to_ready', {})[asg_name] = duration
+            del SCALE_UPS[asg_name]
+
+
+def get_warm_pools(asgs: dict):
+    '''
+    Return the warm pool configuration and number of warm pool instances per ASG
+
+    The warm pools are part of the (cached) ASG descriptions, i.e. no extra DescribeWarmPool call per ASG is needed.
+    '''
+    warm_pools = {}
+    for asg_name, asg in sorted(asgs.items()):
+        config = asg.get('WarmPoolConfiguration')
+        if config:
+            warm_pools[asg_name] = {'min_size': config.get('MinSize', 0),
+                                    'max_prepared_capacity': config.get('MaxGroupPreparedCapacity'),
+                                    'pool_state': config.get('PoolState', 'Stopped'),
+                                    'warmed': asg.get('WarmPoolSize', 0)}
+    return warm_pools
+
+
+def get_required_warm_pool_size(asg_name: str, warm_pool_min_size: int):
+    '''
+    Return the warm pool size needed to serve the largest recent scale-up of the given ASG
+    '''
+    now = time.time()
+    recent_scale_ups = [count for timestamp, count in SCALE_UP_HISTORY.get(asg_name, [])
+                        if timestamp >= now - WARM_POOL_HISTORY_SECONDS]
+    return max([warm_pool_min_size] + recent_scale_ups)
+
+
+def update_warm_pools(autoscaling, asgs: dict, warm_pools: dict, warm_pool_min_size: int, dry_run: bool=False):
+    '''
+    Resize the warm pools of the given ASG descriptions to keep enough pre-initialized instances for the next scale-up,
+    warm pools are only created for ASGs tagged with WARM_POOL_TAG
+    '''
+    for asg_name, asg in sorted(asgs.items()):
+        if 'MixedInstancesPolicy' in asg:
+            # AWS does not support warm pools for ASGs with mixed instance types or spot instances
+            continue
+        warm_pool = warm_pools.get(asg_name)
+        if not warm_pool and not any(tag['Key'] == WARM_POOL_TAG for tag in asg.get('Tags', [])):
+            continue
+        required_size = get_required_warm_pool_size(asg_name, warm_pool_min_size)
+        # without a maximum the pool would hold MaxSize minus DesiredCapacity instances
+        max_prepared_capacity = asg['DesiredCapacity'] + required_size
+        if warm_pool and warm_pool['min_size'] == required_size and warm_pool['max_prepared_capacity'] == max_prepared_capacity:
+            continue
+        logger.info('Changing warm pool size for ASG {} from {} to {}..'.format(
+                    asg_name, warm_pool['min_size'] if warm_pool else None, required_size))
+        if dry_run:
+            logger.info('**DRY-RUN**: not performing any change')
+        else:
+            pool_state = warm_pool['pool_state'] if warm_pool else 'Stopped'
+            try:
+                autoscaling.put_warm_pool(AutoScalingGroupName=asg_name, MinSize=required_size,
+                                          MaxGroupPreparedCapacity=max_prepared_capacity, PoolState=pool_state)
+            except Exception:
+                logger.exception('Failed to update the warm pool of ASG {}'.format(asg_name))
+            finally:
+                ASG_CACHE.pop(asg_name, None)
+
+
+def set_node_unschedulable(api, node_name: str, unschedulable: bool):
+    patch = {'spec': {'unschedulable': unschedulable}}
+    response = api.patch(url='nodes/{}'.format(node_name), headers={'Content-Type': 'application/merge-patch+json'},
+                         data=json.dumps(patch))
+    api.raise_for_status(response)
+
+
+def is_evictable_pod(pod):
+    '''
+    Return False for pods which are not evicted by draining, i.e. DaemonSet pods, mirror pods and finished pods
+    '''
+    if pod.obj['status'].get('phase') in ('Succeeded', 'Failed'):
+        return False
+    metadata = pod.obj['metadata']
+    if 'kubernetes.io/config.mirror' in metadata.get('annotations', {}):
+        return False
+    for owner in metadata.get('ownerReferences', []):
+        if owner.get('kind') == 'DaemonSet':
+            return False
+    return True
+
+
+def get_evictable_pods(api, node_name: str):
+    import pykube
+
+    pods = pykube.Pod.objects(api).filter(namespace=pykube.all, field_selector={'spec.nodeName': node_name})
+    return [pod for pod in pods if is_evictable_pod(pod)]
+
+
+def drain_node(api, node_name: str, timeout: int):
+    '''
+    Evict all pods from the given (cordoned) node and wait until they are gone.
+
+    Return False if an eviction was refused (e.g. because of a PodDisruptionBudget) or the timeout was reached.
+    '''
+    for pod in get_evictable_pods(api, node_name):
+        for api_version in EVICTION_API_VERSIONS:
+            eviction = {'apiVersion': api_version, 'kind': 'Eviction',
+                        'metadata': {'name': pod.name, 'namespace': pod.namespace}}
+            response = api.post(url='pods/{}/eviction'.format(pod.name), namespace=pod.namespace, data=json.dumps(eviction))
+            if response.status_code != 400:
+                break
+        if response.status_code == 429:
+            logger.info('Eviction of pod {}/{} was refused, not draining node {}'.format(pod.namespace, pod.name, node_name))
+            return False
+        elif response.status_code != 404:
+            api.raise_for_status(response)
+
+    deadline = time.time() + timeout
+    while get_evictable_pods(api, node_name):
+        if time.time() > deadline:
+            logger.warning('Timeout while draining node {}'.format(node_name))
+            return False
+        time.sleep(DRAIN_POLL_INTERVAL)
+    return True
+
+
+def terminate_least_utilized_nodes(api, autoscaling, nodes: list, count: int, drain_timeout: int, dry_run: bool=False):
+    '''
+    Cordon, drain and terminate the least utilized nodes (decrementing the ASG's desired capacity)
+    until their capacity units add up to the given count, without exceeding it
+    '''
+    candidates = find_least_utilized_nodes(nodes)
+    nodes_per_zone = collections.Counter(node['zone'] for node in nodes)
+    while count > 0:
+        candidates = [node for node in candidates if node.get('capacity_units', 1) <= count]
+        if not candidates:
+            logger.info('No more nodes eligible for termination')
+            break
+        # prefer nodes in the zone with most nodes to keep the ASG balanced across AZs
+        node = max(candidates, key=lambda n: nodes_per_zone[n['zone']])
+        candidates.remove(node)
+        nodes_per_zone[node['zone']] -= 1
+        count -= node.get('capacity_units', 1)
+        logger.info('Terminating least utilized node {} ({} pods, {:.0f}% utilization) in ASG {}..'.format(
+                    node['name'], node.get('requested', {}).get('pods', 0), get_node_utilization(node) * 100, node['asg_name']))
+        if dry_run:
+            logger.info('**DRY-RUN**: not performing any change')
+            continue
+        try:
+            set_node_unschedulable(api, node['name'], True)
+            if drain_node(api, node['name'], drain_timeout):
+                try:
+                    autoscaling.terminate_instance_in_auto_scaling_group(InstanceId=node['instance_id'],
+                                                                         ShouldDecrementDesiredCapacity=True)
+                finally:
+                    ASG_CACHE.pop(node['asg_name'], None)
+                continue
+        except Exception:
+            logger.exception('Failed to terminate node {} (instance {})'.format(node['name'], node['instance_id']))
+        # the node is still running: make it schedulable again
+        try:
+            set_node_unschedulable(api, node['name'], False)
+        except Exception:
+            logger.exception('Failed to uncordon node {}'.format(node['name']))
+
+
+def get_auto_scaling_groups(autoscaling, asg_names: list, cache_ttl: int=0):
+    '''
+    Return the ASG descriptions, all ASGs not cached within the last cache_ttl seconds are described in one batch
+    '''
+    now = time.time()
     asgs = {}
-    response = autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=list(asg_size.keys()))
-    for asg in response['AutoScalingGroups']:
-        asgs[asg['AutoScalingGroupName']] = asg
+    stale = []
+    for asg_name in sorted(asg_names):
+        cached = ASG_CACHE.get(asg_name)
+        if cached and now - cached[0] < cache_ttl:
+            asgs[asg_name] = cached[1]
+        else:
+            stale.append(asg_name)
+
+    kwargs = {}
+    while stale:
+        # results are paginated (50 ASGs per page)
+        response = autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=stale, **kwargs)
+        for asg in response['AutoScalingGroups']:
+            asgs[asg['AutoScalingGroupName']] = asg
+            ASG_CACHE[asg['AutoScalingGroupName']] = (now, asg)
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+    return asgs
+
+
+def discover_auto_scaling_groups(autoscaling, tag_key: str):
+    '''
+    Return the names (and region) of all ASGs with the given tag, including ASGs without any instance
+    '''
+    asg_regions = {}
+    kwargs = {}
+    while True:
+        response = autoscaling.describe_auto_scaling_groups(Filters=[{'Name': 'tag-key', 'Values': [tag_key]}], **kwargs)
+        for asg in response['AutoScalingGroups']:
+            asg_regions[asg['AutoScalingGroupName']] = autoscaling.meta.region_name
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+    return asg_regions
+
+
+def add_discovered_asg_regions(autoscaling_by_region: dict, asg_regions: dict, tag_key: str):
+    '''
+    Add the ASGs with the given tag key (also the ones without any node) to the given regions by ASG name
+    '''
+    for asg_name, region in run_per_region(discover_auto_scaling_groups, autoscaling_by_region,
+                                           {region: tag_key for region in autoscaling_by_region}).items():
+        asg_regions.setdefault(asg_name, region)
+
+
+def get_in_flight_instances(asgs: dict, nodes_by_asg_zone: dict, join_timeout: int=DEFAULT_JOIN_TIMEOUT):
+    '''
+    Return the number of launched instances per ASG which did not register as node yet
+
+    Instances not joining within the join timeout are not counted anymore.
+    '''
+    now = time.time()
+    registered = set()
+    node_counts_by_asg = collections.defaultdict(int)
+    for (asg_name, _), nodes in nodes_by_asg_zone.items():
+        node_counts_by_asg[asg_name] += get_capacity_units(nodes)
+        registered.update(node['instance_id'] for node in nodes)
+
+    in_flight_by_asg = {}
+    for asg_name, asg in sorted(asgs.items()):
+        scale_up = SCALE_UPS.get(asg_name)
+        if scale_up and now - scale_up['started'] > join_timeout:
+            # the scale-up did not complete in time, later instances (e.g. replacements) are not part of it
+            logger.warning('Not all nodes of the scale-up of ASG {} from {} to {} were ready within {}s'.format(
+                           asg_name, scale_up['from'], scale_up['to'], join_timeout))
+            del SCALE_UPS[asg_name]
+            scale_up = None
+        in_flight = 0
+        launching = set()
+        for instance in asg.get('Instances', []):
+            instance_id = instance['InstanceId']
+            if instance_id in registered:
+                tracked = IN_FLIGHT.pop(instance_id, None)
+                if tracked:
+                    duration = now - tracked['since']
+                    logger.info('Instance {} of ASG {} joined the cluster after {:.0f}s'.format(instance_id, asg_name, duration))
+                    STATS.setdefault('time_to_join', {})[asg_name] = duration
+            elif instance['LifecycleState'] in LAUNCHING_LIFECYCLE_STATES:
+                launching.add(instance_id)
+                # instances launched by our own scale-up are tracked since the desired capacity was changed
+                tracked = IN_FLIGHT.setdefault(instance_id, {'asg_name': asg_name,
+                                                             'since': scale_up['started'] if scale_up else now})
+                if now - tracked['since'] <= join_timeout:
+                    in_flight += int(instance.get('WeightedCapacity') or 1)
+                elif not tracked.get('timed_out'):
+                    logger.warning('Instance {} of ASG {} did not join the cluster within {}s'.format(
+                                   instance_id, asg_name, join_timeout))
+                    tracked['timed_out'] = True
+        if scale_up:
+            # our own scale-up might not be visible as ASG instances yet
+            in_flight = max(in_flight, scale_up['to'] - node_counts_by_asg[asg_name])
+        for instance_id, tracked in list(IN_FLIGHT.items()):
+            if tracked['asg_name'] == asg_name and instance_id not in launching:
+                # instance was terminated before joining
+                del IN_FLIGHT[instance_id]
+        if in_flight > 0:
+            in_flight_by_asg[asg_name] = in_flight
+    return in_flight_by_asg
+
+
+def resize_auto_scaling_groups(autoscaling, asg_size: dict, ready_nodes_by_asg: dict, dry_run: bool=False,
+                               api=None, nodes_by_asg: dict=None, drain_timeout: int=DEFAULT_DRAIN_TIMEOUT,
+                               warm_pools: dict=None, decision: dict=None, asgs: dict=None, in_flight_by_asg: dict=None):
+    if asgs is None:
+        asgs = get_auto_scaling_groups(autoscaling, asg_size.keys())
 
     for asg_name, desired_capacity in sorted(asg_size.items()):
         asg = asgs[asg_name]
+        asg_decision = get_asg_decision(decision, asg_name)
+        asg_decision.update(required=desired_capacity, current=asg['DesiredCapacity'], min=asg['MinSize'], max=asg['MaxSize'])
         if desired_capacity > asg['MaxSize']:
             logger.warn('Desired capacity for ASG {} is {}, but exceeds max {}'.format(
                         asg_name, desired_capacity, asg['MaxSize']))
             desired_capacity = asg['MaxSize']
+            asg_decision['clamped'] = 'max'
         elif desired_capacity < asg['MinSize']:
             logger.warn('Desired capacity for ASG {} is {}, but is lower than min {}'.format(
                         asg_name, desired_capacity, asg['MinSize']))
             desired_capacity = asg['MinSize']
+            asg_decision['clamped'] = 'min'
         if desired_capacity < asg['DesiredCapacity']:
             # potential scale down, let's check if it is safe..
-            if ready_nodes_by_asg.get(asg_name) < asg['DesiredCapacity']:
+            if (in_flight_by_asg or {}).get(asg_name):
+                logger.info('{} instances of ASG {} did not join the cluster yet, not scaling down from {} to {}'.format(
+                            in_flight_by_asg[asg_name], asg_name, asg['DesiredCapacity'], desired_capacity))
+                desired_capacity = asg['DesiredCapacity']
+                asg_decision['skipped'] = 'instances in flight'
+            elif ready_nodes_by_asg.get(asg_name, 0) < asg['DesiredCapacity']:
                 logger.info('Some nodes are not ready in ASG {}, not scaling down from {} to {}'.format(
                             asg_name, asg['DesiredCapacity'], desired_capacity))
                 desired_capacity = asg['DesiredCapacity']
+                asg_decision['skipped'] = 'nodes not ready'
             elif scaling_activity_in_progress(autoscaling, asg_name):
                 logger.info('Scaling activity in progress for ASG {}, not scaling down from {} to {}'.format(
                             asg_name, asg['DesiredCapacity'], desired_capacity))
                 desired_capacity = asg['DesiredCapacity']
+                asg_decision['skipped'] = 'scaling activity in progress'
+        asg_decision['new'] = desired_capacity
         if desired_capacity != asg['DesiredCapacity']:
             logger.info('Changing desired capacity for ASG {} from {} to {}..'.format(
                         asg_name, asg['DesiredCapacity'], desired_capacity))
-            if dry_run:
+            if desired_capacity < SCALE_UPS.get(asg_name, {}).get('to', 0):
+                # the previous scale-up will never complete
+                del SCALE_UPS[asg_name]
+            warm_pool = (warm_pools or {}).get(asg_name)
+            if warm_pool and desired_capacity > asg['DesiredCapacity']:
+                logger.info('{} of {} new instances for ASG {} can be launched from the warm pool'.format(
+                            min(warm_pool['warmed'], desired_capacity - asg['DesiredCapacity']),
+                            desired_capacity - asg['DesiredCapacity'], asg_name))
+            if desired_capacity < asg['DesiredCapacity'] and nodes_by_asg is not None:
+                nodes = nodes_by_asg.get(asg_name, [])
+                # weighted instances might exceed the desired capacity
+                terminate_least_utilized_nodes(api, autoscaling, nodes, max(asg['DesiredCapacity'], get_capacity_units(nodes)) - desired_capacity,
+                                               drain_timeout, dry_run)
+            elif dry_run:
                 logger.info('**DRY-RUN**: not performing any change')
             else:
                 try:
@@ -343,18 +1169,154 @@ def resize_auto_scaling_groups(autoscaling, asg_size: dict, ready_nodes_by_asg:
                 except Exception:
                     logger.exception('Failed to set desired capacity {} for ASG {}'.format(desired_capacity, asg_name))
                     raise
+                finally:
+                    # describe the ASG again in the next loop
+                    ASG_CACHE.pop(asg_name, None)
+                if desired_capacity > asg['DesiredCapacity']:
+                    record_scale_up(asg_name, asg['DesiredCapacity'], desired_capacity)
+
+
+def get_placeholder_pods(zone_records: list, nodes_by_asg_zone: dict, namespace: str):
+    '''
+    Return the placeholder pods (by name) reserving the buffer (with_buffer minus requested) of the given ASG/AZ decision records
+    '''
+    pods = {}
+    for record in zone_records:
+        asg_name, zone, weakest_node = record['asg_name'], record['zone'], record['weakest_node']
+        buffer = {resource: max(0, record['with_buffer'].get(resource, 0) - record['requested'].get(resource, 0))
+                  for resource in PLACEHOLDER_REQUEST_STEPS}
+        nodes = nodes_by_asg_zone.get((asg_name, zone))
+        if not any(buffer.values()) or not nodes:
+            # placeholders can only be pinned to the instance type of existing nodes
+            continue
+        # split the buffer into pods which fit on the weakest node
+        count = max([1] + [int(math.ceil(value / (weakest_node[resource] * PLACEHOLDER_MAX_NODE_SHARE)))
+                           for resource, value in buffer.items() if weakest_node.get(resource)])
+        requests = {}
+        for resource, step in PLACEHOLDER_REQUEST_STEPS.items():
+            requests[resource] = int(math.ceil(buffer[resource] / count / step)) * step
+        instance_type = find_weakest_node(nodes)['instance_type']
+        for i in range(count):
+            # the name changes with the size, i.e. resized placeholders are replaced
+            key = '{}/{}/{}/{}/{}/{}'.format(asg_name, zone, instance_type, requests['cpu'], requests['memory'], i)
+            name = 'placeholder-{}'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+            pods[name] = {
+                'apiVersion': 'v1', 'kind': 'Pod',
+                'metadata': {'name': name, 'namespace': namespace, 'labels': {PLACEHOLDER_LABEL: 'true'},
+                             'annotations': {PLACEHOLDER_ASG_ANNOTATION: asg_name, PLACEHOLDER_ZONE_ANNOTATION: zone}},
+                'spec': {
+                    'priorityClassName': PLACEHOLDER_PRIORITY_CLASS,
+                    'terminationGracePeriodSeconds': 0,
+                    'nodeSelector': {'failure-domain.beta.kubernetes.io/zone': zone, 'beta.kubernetes.io/instance-type': instance_type},
+                    'containers': [{'name': 'placeholder', 'image': PLACEHOLDER_IMAGE,
+                                    'resources': {'requests': {'cpu': '{}m'.format(requests['cpu']), 'memory': str(requests['memory'])}}}]
+                }
+            }
+    return pods
+
+
+def ensure_placeholder_priority_class(api, dry_run: bool=False):
+    priority_class = {'apiVersion': PRIORITY_CLASS_API_VERSION, 'kind': 'PriorityClass',
+                      'metadata': {'name': PLACEHOLDER_PRIORITY_CLASS},
+                      'value': PLACEHOLDER_PRIORITY, 'globalDefault': False, 'preemptionPolicy': 'Never',
+                      'description': 'Placeholder pods of kube-aws-autoscaler, preempted by any other pod'}
+    response = api.get(url='priorityclasses/{}'.format(PLACEHOLDER_PRIORITY_CLASS), version=PRIORITY_CLASS_API_VERSION)
+    if response.status_code != 404:
+        api.raise_for_status(response)
+        return
+    logger.info('Creating priority class {} for placeholder pods'.format(PLACEHOLDER_PRIORITY_CLASS))
+    if dry_run:
+        logger.info('**DRY-RUN**: not performing any change')
+        return
+    response = api.post(url='priorityclasses', version=PRIORITY_CLASS_API_VERSION, data=json.dumps(priority_class))
+    api.raise_for_status(response)
+
+
+def reconcile_placeholder_pods(api, namespace: str, pods: dict, asg_names: set, known_asg_names: set, dry_run: bool=False):
+    '''
+    Create missing and delete obsolete placeholder pods of the given ASGs
+    (placeholders of ASGs which are not known anymore are deleted, too)
+    '''
+    response = api.get(url='pods', namespace=namespace, params={'labelSelector': PLACEHOLDER_LABEL})
+    api.raise_for_status(response)
+    existing = set()
+    for pod in response.json()['items']:
+        asg_name = pod['metadata'].get('annotations', {}).get(PLACEHOLDER_ASG_ANNOTATION)
+        # placeholders of other shards are left alone
+        if asg_name in asg_names or asg_name not in known_asg_names:
+            existing.add(pod['metadata']['name'])
+
+    for name in sorted(existing - set(pods)):
+        logger.info('Deleting placeholder pod {}/{}..'.format(namespace, name))
+        if dry_run:
+            logger.info('**DRY-RUN**: not performing any change')
+            continue
+        response = api.delete(url='pods/{}'.format(name), namespace=namespace)
+        if response.status_code != 404:
+            api.raise_for_status(response)
+    for name in sorted(set(pods) - existing):
+        pod = pods[name]
+        logger.info('Creating placeholder pod {}/{} for ASG {} in {} ({})..'.format(
+                    namespace, name, pod['metadata']['annotations'][PLACEHOLDER_ASG_ANNOTATION],
+                    pod['metadata']['annotations'][PLACEHOLDER_ZONE_ANNOTATION],
+                    ', '.join('{}={}'.format(k, v) for k, v in sorted(pod['spec']['containers'][0]['resources']['requests'].items()))))
+        if dry_run:
+            logger.info('**DRY-RUN**: not performing any change')
+            continue
+        response = api.post(url='pods', namespace=namespace, data=json.dumps(pod))
+        api.raise_for_status(response)
 
 
 def get_kube_api():
+    import pykube
+
     try:
         config = pykube.KubeConfig.from_service_account()
     except FileNotFoundError:
         # local testing
-        config = pykube.KubeConfig.from_file(os.path.expanduser('~/.kube/config'))
+        config = pykube.KubeConfig.from_file(os.path.expanduser(os.getenv('KUBECONFIG', '~/.kube/config')))
     api = pykube.HTTPClient(config)
     return api
 
 
+def renew_shard_lease(api, namespace: str, identity: str, lease_duration: int):
+    name = 'kube-aws-autoscaler-{}'.format(identity)
+    lease = {'apiVersion': LEASE_API_VERSION, 'kind': 'Lease',
+             'metadata': {'name': name, 'namespace': namespace, 'labels': {SHARD_LEASE_LABEL: 'true'}},
+             'spec': {'holderIdentity': identity, 'leaseDurationSeconds': lease_duration,
+                      'renewTime': datetime.datetime.utcnow().strftime(LEASE_TIME_FORMAT)}}
+    response = api.put(url='leases/{}'.format(name), namespace=namespace, version=LEASE_API_VERSION, data=json.dumps(lease))
+    if response.status_code == 404:
+        response = api.post(url='leases', namespace=namespace, version=LEASE_API_VERSION, data=json.dumps(lease))
+    api.raise_for_status(response)
+
+
+def get_shard_members(api, namespace: str, identity: str, lease_duration: int):
+    '''
+    Renew our own lease and return the sorted identities of all autoscaler replicas with a live lease
+    '''
+    renew_shard_lease(api, namespace, identity, lease_duration)
+    response = api.get(url='leases', namespace=namespace, version=LEASE_API_VERSION,
+                       params={'labelSelector': SHARD_LEASE_LABEL})
+    api.raise_for_status(response)
+    now = datetime.datetime.utcnow()
+    members = set([identity])
+    for lease in response.json()['items']:
+        spec = lease['spec']
+        renew_time = datetime.datetime.strptime(spec['renewTime'], LEASE_TIME_FORMAT)
+        if renew_time + datetime.timedelta(seconds=spec['leaseDurationSeconds']) > now:
+            members.add(spec['holderIdentity'])
+    return sorted(members)
+
+
+def get_asg_owner(asg_name: str, members: list):
+    '''
+    Return the replica responsible for the given ASG (rendezvous hashing, i.e. only the ASGs
+    of a leaving/joining replica move to another one)
+    '''
+    return max(members, key=lambda member: hashlib.sha1('{}/{}'.format(member, asg_name).encode('utf-8')).digest())
+
+
 def get_nodes_by_name(nodes: list):
     nodes_by_name = {}
     for node in nodes:
@@ -368,44 +1330,286 @@ def get_ready_nodes_by_asg(nodes_by_asg_zone):
         asg_name, _ = key
         for node in nodes:
             if node['ready']:
-                ready_nodes_by_asg[asg_name] += 1
+                ready_nodes_by_asg[asg_name] += node.get('capacity_units', 1)
     return ready_nodes_by_asg
 
 
-@app.route('/healthz')
 def is_healthy():
+    from flask import jsonify
+
     if Healthy:
         return jsonify({'status': 'OK'})
     else:
         return jsonify({'status': 'UNHEALTHY'}), 503
 
 
+def get_decisions():
+    from flask import jsonify, request
+
+    limit = int(request.args.get('limit', DECISION_LOG_SIZE))
+    return jsonify(list(DECISIONS)[-limit:] if limit > 0 else [])
+
+
+def what_if():
+    from flask import jsonify, request
+
+    # the autoscaling loop might update the state meanwhile
+    state = dict(CLUSTER_STATE)
+    if not state:
+        return jsonify({'error': 'No cluster state available yet'}), 503
+    configs = request.get_json()
+    if not isinstance(configs, list):
+        return jsonify({'error': 'Expected a JSON list of configurations'}), 400
+    try:
+        results = evaluate_what_if(state['nodes_by_asg_zone'], state['usage_by_asg_zone'], configs,
+                                   state.get('capacity_by_asg'), state.get('pending_requests'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(results)
+
+
+def enable_profiling():
+    from flask import jsonify, request
+
+    PROFILE['iterations'] = int(request.args.get('iterations', 1))
+    return jsonify({'iterations': PROFILE['iterations'], 'directory': PROFILE['directory']})
+
+
+def get_app():
+    global APP
+    if APP is None:
+        from flask import Flask
+
+        APP = Flask(__name__)
+        APP.add_url_rule('/healthz', view_func=is_healthy)
+        APP.add_url_rule('/decisions', view_func=get_decisions)
+        APP.add_url_rule('/what-if', view_func=what_if, methods=['POST'])
+        APP.add_url_rule('/profile', view_func=enable_profiling, methods=['POST'])
+        APP.add_url_rule('/history', view_func=get_history)
+    return APP
+
+
+def get_history():
+    from flask import jsonify, request
+
+    if not METRICS['path']:
+        return jsonify({'error': 'No metrics database configured'}), 404
+    conditions = []
+    params = []
+    try:
+        for condition, arg, type_ in (('metric = ?', 'metric', str), ('asg_name = ?', 'asg', str), ('zone = ?', 'zone', str),
+                                      ('timestamp >= ?', 'since', int), ('timestamp < ?', 'until', int)):
+            if arg in request.args:
+                conditions.append(condition)
+                params.append(type_(request.args[arg]))
+        limit = int(request.args.get('limit', METRICS_QUERY_LIMIT))
+        if limit < 1:
+            # SQLite treats a negative limit as no limit at all
+            raise ValueError('limit must be positive')
+        params.append(min(limit, METRICS_QUERY_LIMIT))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    query = 'SELECT {} FROM samples {} ORDER BY timestamp LIMIT ?'.format(
+        ', '.join(METRICS_COLUMNS), 'WHERE ' + ' AND '.join(conditions) if conditions else '')
+    # the autoscale loop's connection must not be shared with the web server thread
+    connection = sqlite3.connect(METRICS['path'])
+    try:
+        rows = connection.execute(query, params).fetchall()
+    finally:
+        connection.close()
+    return jsonify([dict(zip(METRICS_COLUMNS, row)) for row in rows])
+
+
 def start_health_endpoint():
-    app.run(host='0.0.0.0', port=5000)
+    get_app().run(host='0.0.0.0', port=5000)
 
 
-def autoscale(buffer_percentage: dict, buffer_fixed: dict,
-              scale_down_step_fixed: int, scale_down_step_percentage: float,
-              buffer_spare_nodes: int = 0, include_master_nodes: bool=False,
-              dry_run: bool=False, disable_scale_down: bool=False):
-    api = get_kube_api()
+def run_profiled(func, directory: str, *args, **kwargs):
+    '''
+    Call the given function with cProfile and tracemalloc enabled,
+    write the results to the given directory and log the hottest functions
+    '''
+    prefix = os.path.join(directory, 'autoscale-{:.0f}'.format(time.time() * 1000))
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(prefix + '.prof')
+        with open(prefix + '-allocations.txt', 'w') as fd:
+            for stat in snapshot.statistics('lineno')[:PROFILE_TOP_ENTRIES]:
+                fd.write('{}\n'.format(stat))
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP_ENTRIES)
+        logger.info('Profiled autoscale loop, results written to {}.prof and {}-allocations.txt:\n{}'.format(
+                    prefix, prefix, out.getvalue()))
+
+
+def get_pods_by_namespace(api, concurrency: int):
+    '''
+    List the pods of every namespace with the given number of concurrent requests,
+    pods are yielded as soon as their namespace is done
+    '''
+    import pykube
+
+    namespaces = [namespace.name for namespace in pykube.Namespace.objects(api)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(list, pykube.Pod.objects(api, namespace=namespace)) for namespace in namespaces]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+def get_pods(api, concurrency: int=0):
+    import pykube
+
+    if concurrency > 1:
+        return get_pods_by_namespace(api, concurrency)
+    return pykube.Pod.objects(api, namespace=pykube.all)
+
+
+def get_autoscaling_client(region: str):
+    if region not in AUTOSCALING_CLIENTS:
+        import boto3
+        AUTOSCALING_CLIENTS[region] = boto3.client('autoscaling', region)
+    return AUTOSCALING_CLIENTS[region]
+
+
+def get_asg_regions(nodes_by_asg_zone: dict):
+    asg_regions = {}
+    for (asg_name, _), nodes in sorted(nodes_by_asg_zone.items()):
+        for node in nodes:
+            asg_regions[asg_name] = node['region']
+    return asg_regions
+
+
+def split_by_region(items: dict, regions: dict, default_region: str):
+    '''
+    Split a dict keyed by ASG name (or node name) into one dict per region
+    '''
+    items_by_region = collections.defaultdict(dict)
+    for key, value in items.items():
+        items_by_region[regions.get(key, default_region)][key] = value
+    return items_by_region
+
 
+def run_per_region(func, autoscaling_by_region: dict, items_by_region: dict, *args, **kwargs):
+    '''
+    Call func(autoscaling, items, ...) for all regions concurrently and merge the returned dicts
+    '''
+    result = {}
+    if not items_by_region:
+        return result
+    with ThreadPoolExecutor(max_workers=len(items_by_region)) as executor:
+        futures = [executor.submit(func, autoscaling_by_region[region], items, *args, **kwargs)
+                   for region, items in sorted(items_by_region.items())]
+        for future in futures:
+            result.update(future.result() or {})
+    return result
+
+
+def get_cluster_state(api, include_master_nodes: bool=False, pod_list_concurrency: int=0):
+    '''
+    Return the AutoScaling clients per region, the nodes and the requested resources per ASG/AZ
+    and the requests of every pending pod
+    '''
     all_nodes = get_nodes(api, include_master_nodes)
-    region = list(all_nodes.values())[0]['region']
-    autoscaling = boto3.client('autoscaling', region)
-    nodes_by_asg_zone = get_nodes_by_asg_zone(autoscaling, all_nodes)
+    nodes_by_region = split_by_region(all_nodes, {name: node['region'] for name, node in all_nodes.items()}, None)
+    autoscaling_by_region = {region: get_autoscaling_client(region) for region in sorted(nodes_by_region)}
+    nodes_by_asg_zone = collections.defaultdict(list)
+    nodes_by_asg_zone.update(run_per_region(get_nodes_by_asg_zone, autoscaling_by_region, nodes_by_region))
 
     # we only consider nodes found in an ASG (old "ghost" nodes returned from Kubernetes API are ignored)
     nodes_by_name = get_nodes_by_name(itertools.chain(*nodes_by_asg_zone.values()))
 
-    pods = pykube.Pod.objects(api, namespace=pykube.all)
+    pods = get_pods(api, pod_list_concurrency)
+
+    pending_requests = []
+    usage_by_asg_zone = calculate_usage_by_asg_zone(pods, nodes_by_name, pending_requests)
+    return autoscaling_by_region, nodes_by_asg_zone, usage_by_asg_zone, pending_requests
+
+
+def autoscale(buffer_percentage: dict, buffer_fixed: dict,
+              scale_down_step_fixed: int, scale_down_step_percentage: float,
+              buffer_spare_nodes: int = 0, include_master_nodes: bool=False,
+              dry_run: bool=False, disable_scale_down: bool=False,
+              terminate_least_utilized: bool=False, drain_timeout: int=DEFAULT_DRAIN_TIMEOUT,
+              warm_pool_min_size: int=None, shard_identity: str=None, shard_namespace: str='default',
+              shard_lease_duration: int=180, pod_list_concurrency: int=0, join_timeout: int=DEFAULT_JOIN_TIMEOUT,
+              asg_cache_ttl: int=0, metrics_db: str=None, placeholder_namespace: str=None,
+              discover_asg_tag: str=None, spot_capacity_factor: float=1.0):
+    api = get_kube_api()
+    autoscaling_by_region, nodes_by_asg_zone, usage_by_asg_zone, pending_requests = get_cluster_state(api, include_master_nodes,
+                                                                                                      pod_list_concurrency)
+    asg_regions = get_asg_regions(nodes_by_asg_zone)
+    # ASGs without any node (e.g. scaled to zero) are looked up in the first region
+    default_region = min(autoscaling_by_region, default=None)
 
-    usage_by_asg_zone = calculate_usage_by_asg_zone(pods, nodes_by_name)
-    asg_size = calculate_required_auto_scaling_group_sizes(nodes_by_asg_zone, usage_by_asg_zone, buffer_percentage, buffer_fixed,
-                                                           buffer_spare_nodes=buffer_spare_nodes, disable_scale_down=disable_scale_down)
-    asg_size = slow_down_downscale(asg_size, nodes_by_asg_zone, scale_down_step_fixed, scale_down_step_percentage)
-    ready_nodes_by_asg = get_ready_nodes_by_asg(nodes_by_asg_zone)
-    resize_auto_scaling_groups(autoscaling, asg_size, ready_nodes_by_asg, dry_run)
+    decision = {'timestamp': time.time(), 'zones': [], 'asgs': {}}
+    try:
+        if discover_asg_tag:
+            add_discovered_asg_regions(autoscaling_by_region, asg_regions, discover_asg_tag)
+        asg_names = set(asg_regions)
+        if shard_identity:
+            members = get_shard_members(api, shard_namespace, shard_identity, shard_lease_duration)
+            asg_names = set(asg_name for asg_name in asg_names if get_asg_owner(asg_name, members) == shard_identity)
+            logger.debug('Shard {} of {} replicas owns ASGs: {}'.format(shard_identity, len(members), ', '.join(sorted(asg_names))))
+        asgs = run_per_region(get_auto_scaling_groups, autoscaling_by_region,
+                              split_by_region(dict.fromkeys(asg_names), asg_regions, default_region), asg_cache_ttl)
+        capacity_by_asg = get_capacity_model(asgs, nodes_by_asg_zone, spot_capacity_factor)
+        # keep the last state for what-if analysis, the nodes are copied as the next loop adds the AZs of ASGs without nodes
+        CLUSTER_STATE.update(nodes_by_asg_zone=dict(nodes_by_asg_zone), usage_by_asg_zone=usage_by_asg_zone,
+                             pending_requests=pending_requests, capacity_by_asg=capacity_by_asg, timestamp=time.time())
+        asg_size = calculate_required_auto_scaling_group_sizes(nodes_by_asg_zone, usage_by_asg_zone, buffer_percentage, buffer_fixed,
+                                                               buffer_spare_nodes=buffer_spare_nodes,
+                                                               disable_scale_down=disable_scale_down, decision=decision,
+                                                               capacity_by_asg=capacity_by_asg, pending_requests=pending_requests)
+        if shard_identity:
+            asg_size = {asg_name: size for asg_name, size in asg_size.items() if get_asg_owner(asg_name, members) == shard_identity}
+        in_flight_by_asg = get_in_flight_instances(asgs, nodes_by_asg_zone, join_timeout)
+        for asg_name, in_flight in in_flight_by_asg.items():
+            get_asg_decision(decision, asg_name)['in_flight'] = in_flight
+        asg_size = slow_down_downscale(asg_size, nodes_by_asg_zone, scale_down_step_fixed, scale_down_step_percentage, decision,
+                                       in_flight_by_asg)
+        ready_nodes_by_asg = get_ready_nodes_by_asg(nodes_by_asg_zone)
+        report_scale_up_readiness(ready_nodes_by_asg)
+        asg_size_by_region = split_by_region(asg_size, asg_regions, default_region)
+        warm_pools = None
+        if warm_pool_min_size is not None:
+            warm_pools = get_warm_pools({asg_name: asg for asg_name, asg in asgs.items() if asg_name in asg_size})
+        nodes_by_asg = None
+        if terminate_least_utilized:
+            nodes_by_asg = collections.defaultdict(list)
+            for (asg_name, _), nodes in nodes_by_asg_zone.items():
+                nodes_by_asg[asg_name].extend(nodes)
+        run_per_region(resize_auto_scaling_groups, autoscaling_by_region, asg_size_by_region, ready_nodes_by_asg, dry_run,
+                       api=api, nodes_by_asg=nodes_by_asg, drain_timeout=drain_timeout,
+                       warm_pools=warm_pools, decision=decision, asgs=asgs, in_flight_by_asg=in_flight_by_asg)
+        if warm_pools is not None:
+            run_per_region(update_warm_pools, autoscaling_by_region,
+                           split_by_region({asg_name: asg for asg_name, asg in asgs.items() if asg_name in asg_size}, asg_regions, default_region),
+                           warm_pools, warm_pool_min_size, dry_run)
+        if placeholder_namespace:
+            zone_records = [record for record in decision['zones'] if record['asg_name'] in asg_size]
+            ensure_placeholder_priority_class(api, dry_run)
+            reconcile_placeholder_pods(api, placeholder_namespace,
+                                       get_placeholder_pods(zone_records, nodes_by_asg_zone, placeholder_namespace),
+                                       set(asg_size), set(asg_regions), dry_run)
+    except Exception as e:
+        decision['error'] = str(e)
+        raise
+    finally:
+        DECISIONS.append(decision)
+        if metrics_db:
+            try:
+                record_metrics(metrics_db, decision)
+            except Exception:
+                logger.exception('Failed to write metrics to {}'.format(metrics_db))
 
 
 def main():
@@ -423,6 +1627,46 @@ def main():
     parser.add_argument('--enable-healthcheck-endpoint', help='Enable Healtcheck',
                         action='store_true')
     parser.add_argument('--no-scale-down', help='Disable scaling down', action='store_true')
+    parser.add_argument('--scale-down-terminate-least-utilized',
+                        help='Scale down by draining and terminating the least utilized node instead of lowering the desired capacity',
+                        action='store_true')
+    parser.add_argument('--drain-timeout', type=int,
+                        help='Time to wait for pods to be evicted before giving up on a node (default: {}s)'.format(DEFAULT_DRAIN_TIMEOUT),
+                        default=os.getenv('DRAIN_TIMEOUT', DEFAULT_DRAIN_TIMEOUT))
+    parser.add_argument('--warm-pool-min-size', type=int,
+                        help='Manage ASG warm pools with at least this many pre-initialized instances (default: disabled)',
+                        default=os.getenv('WARM_POOL_MIN_SIZE'))
+    parser.add_argument('--profile', type=int, metavar='N', default=0,
+                        help='Profile the first N loop iterations (CPU and memory allocations)')
+    parser.add_argument('--profile-directory', default=os.getenv('PROFILE_DIRECTORY', tempfile.gettempdir()),
+                        help='Directory to write profiling results to (default: {})'.format(tempfile.gettempdir()))
+    parser.add_argument('--pod-list-concurrency', type=int, metavar='N',
+                        help='List pods per namespace with N concurrent requests instead of a single list over all namespaces',
+                        default=os.getenv('POD_LIST_CONCURRENCY', 0))
+    parser.add_argument('--join-timeout', type=int,
+                        help='Time to wait for launched instances to register as nodes (default: {}s)'.format(DEFAULT_JOIN_TIMEOUT),
+                        default=os.getenv('JOIN_TIMEOUT', DEFAULT_JOIN_TIMEOUT))
+    parser.add_argument('--asg-cache-ttl', type=int,
+                        help='Reuse ASG descriptions for this many seconds unless we changed the ASG (default: 0, i.e. disabled)',
+                        default=os.getenv('ASG_CACHE_TTL', 0))
+    parser.add_argument('--metrics-db', metavar='PATH', default=os.getenv('METRICS_DB'),
+                        help='Keep the history of requested resources and ASG sizes in this SQLite database (served by GET /history)')
+    parser.add_argument('--placeholder-pods', action='store_true',
+                        help='Reserve the buffer with low priority placeholder pods which are preempted by real pods')
+    parser.add_argument('--placeholder-namespace', help='Namespace for the placeholder pods (default: $POD_NAMESPACE or "default")',
+                        default=os.getenv('POD_NAMESPACE', 'default'))
+    parser.add_argument('--discover-asg-tag', metavar='KEY', default=os.getenv('DISCOVER_ASG_TAG'),
+                        help='Also manage all ASGs with this tag key, even without any node (i.e. allow scaling from zero)')
+    parser.add_argument('--spot-capacity-factor', type=float, default=os.getenv('SPOT_CAPACITY_FACTOR', 1.0),
+                        help='Count spot capacity of mixed instances ASGs only with this factor (default: 1.0)')
+    parser.add_argument('--what-if', metavar='FILE',
+                        help='Print the ASG sizes for each configuration in the given JSON file (list of option dicts) and exit')
+    parser.add_argument('--enable-sharding', action='store_true',
+                        help='Split ASGs across all autoscaler replicas (coordinated via Kubernetes leases)')
+    parser.add_argument('--shard-identity', help='Unique name of this replica (default: $POD_NAME or hostname)',
+                        default=os.getenv('POD_NAME', socket.gethostname()))
+    parser.add_argument('--shard-namespace', help='Namespace for the sharding leases (default: $POD_NAMESPACE or "default")',
+                        default=os.getenv('POD_NAMESPACE', 'default'))
 
     for resource in RESOURCES:
         parser.add_argument('--buffer-{}-percentage'.format(resource), type=float,
@@ -458,7 +1702,22 @@ def main():
     buffer_fixed = {}
     for resource in RESOURCES:
         buffer_percentage[resource] = getattr(args, 'buffer_{}_percentage'.format(resource))
-        buffer_fixed[resource] = parse_resource(getattr(args, 'buffer_{}_fixed'.format(resource)))
+        buffer_fixed[resource] = parse_resource(getattr(args, 'buffer_{}_fixed'.format(resource)), resource)
+
+    if args.what_if:
+        with open(args.what_if) as fd:
+            configs = json.load(fd)
+        autoscaling_by_region, nodes_by_asg_zone, usage_by_asg_zone, pending_requests = get_cluster_state(
+            get_kube_api(), args.include_master_nodes, args.pod_list_concurrency)
+        asg_regions = get_asg_regions(nodes_by_asg_zone)
+        if args.discover_asg_tag:
+            add_discovered_asg_regions(autoscaling_by_region, asg_regions, args.discover_asg_tag)
+        asgs = run_per_region(get_auto_scaling_groups, autoscaling_by_region,
+                              split_by_region(dict.fromkeys(asg_regions), asg_regions, min(autoscaling_by_region, default=None)))
+        capacity_by_asg = get_capacity_model(asgs, nodes_by_asg_zone, args.spot_capacity_factor)
+        print(json.dumps(evaluate_what_if(nodes_by_asg_zone, usage_by_asg_zone, configs, capacity_by_asg, pending_requests),
+                         indent=2, sort_keys=True))
+        return
 
     if args.dry_run:
         logger.info('**DRY-RUN**: no autoscaling will be performed!')
@@ -467,15 +1726,37 @@ def main():
         t = Thread(target=start_health_endpoint, daemon=True)
         t.start()
 
+    autoscale_kwargs = dict(scale_down_step_fixed=args.scale_down_step_fixed,
+                            scale_down_step_percentage=args.scale_down_step_percentage,
+                            buffer_spare_nodes=args.buffer_spare_nodes,
+                            include_master_nodes=args.include_master_nodes, dry_run=args.dry_run,
+                            disable_scale_down=args.no_scale_down,
+                            terminate_least_utilized=args.scale_down_terminate_least_utilized,
+                            drain_timeout=args.drain_timeout,
+                            warm_pool_min_size=args.warm_pool_min_size,
+                            shard_identity=args.shard_identity if args.enable_sharding else None,
+                            shard_namespace=args.shard_namespace,
+                            # replicas missing more than two loops are considered gone
+                            shard_lease_duration=args.interval * 3,
+                            pod_list_concurrency=args.pod_list_concurrency,
+                            join_timeout=args.join_timeout,
+                            asg_cache_ttl=args.asg_cache_ttl,
+                            metrics_db=args.metrics_db,
+                            placeholder_namespace=args.placeholder_namespace if args.placeholder_pods else None,
+                            discover_asg_tag=args.discover_asg_tag,
+                            spot_capacity_factor=args.spot_capacity_factor)
+
+    PROFILE['iterations'] = args.profile
+    PROFILE['directory'] = args.profile_directory
+
     global Healthy
     while True:
         try:
-            autoscale(buffer_percentage, buffer_fixed,
-                      scale_down_step_fixed=args.scale_down_step_fixed,
-                      scale_down_step_percentage=args.scale_down_step_percentage,
-                      buffer_spare_nodes=args.buffer_spare_nodes,
-                      include_master_nodes=args.include_master_nodes, dry_run=args.dry_run,
-                      disable_scale_down=args.no_scale_down)
+            if PROFILE['iterations'] > 0:
+                PROFILE['iterations'] -= 1
+                run_profiled(autoscale, PROFILE['directory'], buffer_percentage, buffer_fixed, **autoscale_kwargs)
+            else:
+                autoscale(buffer_percentage, buffer_fixed, **autoscale_kwargs)
             Healthy = True
         except Exception:
             Healthy = False
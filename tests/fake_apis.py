@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+'''
+Local HTTP stand-ins for the Kubernetes API server and the AWS AutoScaling API.
+
+They allow running the real autoscale() function (pykube, boto3, HTTP, JSON/XML decoding)
+against a generated cluster without touching a real cluster or AWS account, e.g. as load test:
+
+    python tests/fake_apis.py --nodes 10000 --pods-per-node 30 --aws-latency 0.05
+'''
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import socketserver
+import tempfile
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+AUTOSCALING_XMLNS = 'http://autoscaling.amazonaws.com/doc/2011-01-01/'
+# AWS returns at most 50 ASGs per DescribeAutoScalingGroups page by default
+DESCRIBE_AUTO_SCALING_GROUPS_PAGE_SIZE = 50
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is only available on Python 3.7+
+    daemon_threads = True
+
+
+class FakeCluster:
+    '''
+    Generated cluster state shared by the fake Kubernetes and AutoScaling APIs
+    '''
+
+    def __init__(self, nodes: int=10, pods_per_node: int=10, asgs: int=1, zones: int=3,
+                 region: str='eu-central-1', namespaces: int=10):
+        self.lock = threading.Lock()
+        self.resource_version = itertools.count(1)
+        self.region = region
+        self.nodes = collections.OrderedDict()
+        self.pods = collections.OrderedDict()
+        self.instances = {}
+        self.groups = collections.OrderedDict()
+        self.activities = collections.defaultdict(list)
+        self.set_desired_capacity_calls = []
+        zone_names = ['{}{}'.format(region, chr(ord('a') + i)) for i in range(zones)]
+        for i in range(asgs):
+            asg_name = 'asg-{}'.format(i)
+            self.groups[asg_name] = {'AutoScalingGroupName': asg_name, 'MinSize': 0, 'MaxSize': nodes * 2,
+                                     'DesiredCapacity': 0, 'AvailabilityZones': zone_names, 'Instances': []}
+        for i in range(nodes):
+            asg = self.groups['asg-{}'.format(i % asgs)]
+            zone = zone_names[i % zones]
+            self.add_node('node-{}'.format(i), 'i-{:08x}'.format(i), asg['AutoScalingGroupName'], zone)
+            for j in range(pods_per_node):
+                self.add_pod('default' if namespaces <= 1 else 'ns-{}'.format((i * pods_per_node + j) % namespaces),
+                             'pod-{}-{}'.format(i, j), 'node-{}'.format(i))
+
+    def next_resource_version(self):
+        return str(next(self.resource_version))
+
+    def add_node(self, name: str, instance_id: str, asg_name: str, zone: str):
+        self.nodes[name] = {
+            'kind': 'Node', 'apiVersion': 'v1',
+            'metadata': {'name': name, 'resourceVersion': self.next_resource_version(),
+                         'labels': {'failure-domain.beta.kubernetes.io/region': self.region,
+                                    'failure-domain.beta.kubernetes.io/zone': zone,
+                                    'beta.kubernetes.io/instance-type': 'm5.2xlarge'}},
+            'spec': {'providerID': 'aws:///{}/{}'.format(zone, instance_id)},
+            'status': {'allocatable': {'cpu': '7910m', 'memory': '31Gi', 'pods': '110', 'ephemeral-storage': '95Gi'},
+                       'nodeInfo': {'kubeletVersion': 'v1.11.5'},
+                       'conditions': [{'type': 'Ready', 'status': 'True'}]}}
+        asg = self.groups[asg_name]
+        asg['Instances'].append({'InstanceId': instance_id, 'AvailabilityZone': zone, 'LifecycleState': 'InService',
+                                 'HealthStatus': 'Healthy', 'ProtectedFromScaleIn': False})
+        asg['DesiredCapacity'] += 1
+        self.instances[instance_id] = {'InstanceId': instance_id, 'AutoScalingGroupName': asg_name,
+                                       'AvailabilityZone': zone, 'LifecycleState': 'InService',
+                                       'HealthStatus': 'Healthy', 'ProtectedFromScaleIn': False}
+
+    def add_pod(self, namespace: str, name: str, node_name: str=None, requests: dict=None):
+        spec = {'containers': [{'name': 'main', 'resources': {'requests': requests or {'cpu': '100m', 'memory': '256Mi'}}}]}
+        if node_name:
+            spec['nodeName'] = node_name
+        self.pods[(namespace, name)] = {
+            'kind': 'Pod', 'apiVersion': 'v1',
+            'metadata': {'name': name, 'namespace': namespace, 'resourceVersion': self.next_resource_version()},
+            'spec': spec,
+            'status': {'phase': 'Running' if node_name else 'Pending'}}
+
+
+class FakeKubernetesHandler(BaseHTTPRequestHandler):
+    '''
+    Read-only subset of the Kubernetes API: list and watch nodes, pods and namespaces
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+        cluster = server.cluster
+        with cluster.lock:
+            if parts == ['api', 'v1', 'nodes']:
+                kind, items = 'NodeList', list(cluster.nodes.values())
+            elif parts == ['api', 'v1', 'pods']:
+                kind, items = 'PodList', list(cluster.pods.values())
+            elif len(parts) == 5 and parts[:3] == ['api', 'v1', 'namespaces'] and parts[4] == 'pods':
+                kind, items = 'PodList', [pod for pod in cluster.pods.values() if pod['metadata']['namespace'] == parts[3]]
+            elif parts == ['api', 'v1', 'namespaces']:
+                names = sorted(set(pod['metadata']['namespace'] for pod in cluster.pods.values()))
+                kind, items = 'NamespaceList', [{'kind': 'Namespace', 'apiVersion': 'v1', 'metadata': {'name': name}}
+                                                for name in names]
+            else:
+                self.send_json(404, {'kind': 'Status', 'status': 'Failure', 'reason': 'NotFound', 'code': 404})
+                return
+            resource_version = str(next(cluster.resource_version))
+        server.requests[url.path] += 1
+
+        node_name = params.get('fieldSelector', '').partition('spec.nodeName=')[2]
+        if node_name:
+            items = [item for item in items if item['spec'].get('nodeName') == node_name]
+
+        if params.get('watch') in ('true', '1'):
+            # no long-polling: send all changes since the given resourceVersion and close the stream
+            since = int(params.get('resourceVersion') or 0)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            for item in items:
+                if int(item['metadata'].get('resourceVersion', 0)) > since:
+                    self.wfile.write(json.dumps({'type': 'ADDED', 'object': item}).encode('utf-8') + b'\n')
+            self.close_connection = True
+            return
+
+        metadata = {'resourceVersion': resource_version}
+        limit = int(params.get('limit', 0))
+        if limit:
+            offset = int(params.get('continue') or 0)
+            if offset + limit < len(items):
+                metadata['continue'] = str(offset + limit)
+            items = items[offset:offset + limit]
+        self.send_json(200, {'kind': kind, 'apiVersion': 'v1', 'metadata': metadata, 'items': items})
+
+
+def to_xml(value) -> str:
+    if isinstance(value, dict):
+        return ''.join('<{0}>{1}</{0}>'.format(key, to_xml(val)) for key, val in value.items())
+    elif isinstance(value, list):
+        return ''.join('<member>{}</member>'.format(to_xml(val)) for val in value)
+    elif isinstance(value, bool):
+        return 'true' if value else 'false'
+    return escape(str(value))
+
+
+def get_member_list(params: dict, name: str) -> list:
+    values = []
+    for i in itertools.count(1):
+        key = '{}.member.{}'.format(name, i)
+        if key not in params:
+            return values
+        values.append(params[key])
+
+
+class FakeAutoScalingHandler(BaseHTTPRequestHandler):
+    '''
+    Subset of the AWS AutoScaling query API (form-encoded POST requests, XML responses)
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_xml(self, status: int, body: str):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        time.sleep(server.latency)
+        length = int(self.headers.get('Content-Length', 0))
+        params = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+        action = params.get('Action')
+        server.requests[action] += 1
+        request_id = str(uuid.uuid4())
+        if server.throttle_rate and random.random() < server.throttle_rate:
+            server.requests['Throttled'] += 1
+            self.send_xml(400, '<ErrorResponse xmlns="{}"><Error><Type>Sender</Type><Code>Throttling</Code>'
+                               '<Message>Rate exceeded</Message></Error><RequestId>{}</RequestId></ErrorResponse>'.format(
+                                   AUTOSCALING_XMLNS, request_id))
+            return
+        handler = getattr(self, 'action_{}'.format(action), None)
+        if not handler:
+            self.send_xml(400, '<ErrorResponse xmlns="{}"><Error><Type>Sender</Type><Code>InvalidAction</Code>'
+                               '<Message>{}</Message></Error><RequestId>{}</RequestId></ErrorResponse>'.format(
+                                   AUTOSCALING_XMLNS, escape(str(action)), request_id))
+            return
+        with server.cluster.lock:
+            result = handler(server.cluster, params)
+        self.send_xml(200, '<{0}Response xmlns="{1}"><{0}Result>{2}</{0}Result>'
+                           '<ResponseMetadata><RequestId>{3}</RequestId></ResponseMetadata></{0}Response>'.format(
+                               action, AUTOSCALING_XMLNS, to_xml(result), request_id))
+
+    def action_DescribeAutoScalingInstances(self, cluster, params):
+        instance_ids = get_member_list(params, 'InstanceIds')
+        return {'AutoScalingInstances': [dict(cluster.instances[instance_id], LaunchConfigurationName='fake')
+                                         for instance_id in instance_ids if instance_id in cluster.instances]}
+
+    def action_DescribeAutoScalingGroups(self, cluster, params):
+        names = get_member_list(params, 'AutoScalingGroupNames') or list(cluster.groups)
+        groups = [cluster.groups[name] for name in names if name in cluster.groups]
+        offset = int(params.get('NextToken', 0))
+        page_size = int(params.get('MaxRecords', DESCRIBE_AUTO_SCALING_GROUPS_PAGE_SIZE))
+        result = {'AutoScalingGroups': groups[offset:offset + page_size]}
+        if offset + page_size < len(groups):
+            result['NextToken'] = str(offset + page_size)
+        return result
+
+    def action_DescribeScalingActivities(self, cluster, params):
+        return {'Activities': cluster.activities[params.get('AutoScalingGroupName')][:int(params.get('MaxRecords', 100))]}
+
+    def action_SetDesiredCapacity(self, cluster, params):
+        asg_name = params['AutoScalingGroupName']
+        cluster.groups[asg_name]['DesiredCapacity'] = int(params['DesiredCapacity'])
+        cluster.set_desired_capacity_calls.append((asg_name, int(params['DesiredCapacity'])))
+        return {}
+
+
+def start_server(handler_class, cluster: FakeCluster, latency: float=0, throttle_rate: float=0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    server.cluster = cluster
+    server.latency = latency
+    server.throttle_rate = throttle_rate
+    server.requests = collections.Counter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def get_url(server) -> str:
+    return 'http://{}:{}'.format(*server.server_address)
+
+
+def write_kubeconfig(path: str, server):
+    config = {'apiVersion': 'v1', 'kind': 'Config', 'current-context': 'fake',
+              'clusters': [{'name': 'fake', 'cluster': {'server': get_url(server)}}],
+              'users': [{'name': 'fake', 'user': {}}],
+              'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake'}}]}
+    with open(path, 'w') as fd:
+        json.dump(config, fd)
+
+
+def get_environment(kube_server, autoscaling_server, kubeconfig_path: str) -> dict:
+    '''
+    Return the environment variables pointing pykube and boto3 to the fake APIs
+    '''
+    write_kubeconfig(kubeconfig_path, kube_server)
+    return {'KUBECONFIG': kubeconfig_path,
+            'AWS_ENDPOINT_URL_AUTO_SCALING': get_url(autoscaling_server),
+            'AWS_ACCESS_KEY_ID': 'fake', 'AWS_SECRET_ACCESS_KEY': 'fake', 'AWS_DEFAULT_REGION': autoscaling_server.cluster.region}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run autoscale() against fake Kubernetes and AutoScaling APIs')
+    parser.add_argument('--nodes', type=int, default=10000)
+    parser.add_argument('--pods-per-node', type=int, default=30)
+    parser.add_argument('--asgs', type=int, default=10)
+    parser.add_argument('--namespaces', type=int, default=100)
+    parser.add_argument('--loops', type=int, default=3)
+    parser.add_argument('--kube-latency', type=float, default=0, help='Latency per Kubernetes API request in seconds')
+    parser.add_argument('--aws-latency', type=float, default=0, help='Latency per AWS API request in seconds')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='Fraction of AWS requests to throttle')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.WARNING)
+
+    started = time.time()
+    cluster = FakeCluster(nodes=args.nodes, pods_per_node=args.pods_per_node, asgs=args.asgs, namespaces=args.namespaces)
+    print('Generated {} nodes and {} pods in {:.2f}s'.format(len(cluster.nodes), len(cluster.pods), time.time() - started))
+    kube_server = start_server(FakeKubernetesHandler, cluster, latency=args.kube_latency)
+    autoscaling_server = start_server(FakeAutoScalingHandler, cluster, latency=args.aws_latency,
+                                      throttle_rate=args.throttle_rate)
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.update(get_environment(kube_server, autoscaling_server, os.path.join(directory, 'kubeconfig')))
+
+        startup = time.time()
+        from kube_aws_autoscaler.main import autoscale
+        print('Imported autoscaler in {:.2f}s'.format(time.time() - startup))
+
+        for i in range(args.loops):
+            started = time.time()
+            autoscale({'cpu': 10, 'memory': 10, 'pods': 10}, {'cpu': 200, 'memory': 200 * 1024**2, 'pods': 10},
+                      scale_down_step_fixed=1, scale_down_step_percentage=0.0, buffer_spare_nodes=1, dry_run=True)
+            print('Loop {}: {:.2f}s'.format(i + 1, time.time() - started))
+            if i == 0:
+                # includes importing boto3/pykube and creating the clients
+                print('Time to first decision: {:.2f}s'.format(time.time() - startup))
+    print('Kubernetes API requests: {}'.format(dict(kube_server.requests)))
+    print('AutoScaling API requests: {}'.format(dict(autoscaling_server.requests)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,53 @@
+import collections
+import datetime
+import json
+import logging
 import os
+import subprocess
+import sys
+import time
 from unittest.mock import MagicMock
 import pytest
-from kube_aws_autoscaler.main import (apply_buffer, autoscale,
+from kube_aws_autoscaler.main import (apply_buffer, autoscale, get_auto_scaling_groups,
                                       calculate_required_auto_scaling_group_sizes,
-                                      calculate_usage_by_asg_zone, chunks,
-                                      format_resource, get_kube_api, get_nodes,
-                                      get_nodes_by_asg_zone, is_node_ready,
-                                      is_sufficient, main, parse_resource,
-                                      resize_auto_scaling_groups,
-                                      scaling_activity_in_progress,
-                                      slow_down_downscale, app)
+                                      calculate_usage_by_asg_zone, chunks, drain_node,
+                                      discover_auto_scaling_groups, evaluate_what_if, get_capacity_model,
+                                      find_least_utilized_nodes, get_asg_owner, get_in_flight_instances,
+                                      format_resource, format_zone_decision, get_kube_api, get_nodes, get_required_nodes,
+                                      get_nodes_by_asg_zone, get_placeholder_pods, get_pods, get_shard_members, get_warm_pools, is_node_ready,
+                                      get_weakest_allocatable, is_sufficient, main, parse_resource,
+                                      reconcile_placeholder_pods, record_metrics, report_scale_up_readiness, resize_auto_scaling_groups, run_profiled,
+                                      scaling_activity_in_progress, terminate_least_utilized_nodes,
+                                      slow_down_downscale, update_warm_pools, get_app)
 import kube_aws_autoscaler.main
+from fake_apis import (FakeAutoScalingHandler, FakeCluster,
+                       FakeKubernetesHandler, get_environment, start_server,
+                       write_kubeconfig)
 
 
 def test_parse_resource():
     assert parse_resource('100Mi') == 100*1024*1024
+    assert parse_resource('1.5Gi') == 1536*1024*1024
+    assert parse_resource('1e3') == 1000
+    assert parse_resource('1E') == 1000**6
+    assert parse_resource('12k') == 12000
+    assert parse_resource('0.1') == 1
+    assert parse_resource('2', 'cpu') == 2000
+    assert parse_resource('0.5', 'cpu') == 500
+    assert parse_resource('100m', 'cpu') == 100
+    assert parse_resource('.25', 'cpu') == 250
+    # Kubernetes rounds up to 1m
+    assert parse_resource('1u', 'cpu') == 1
+    assert parse_resource('2e-3', 'cpu') == 2
+    with pytest.raises(ValueError):
+        parse_resource('1.5Mb')
+
+
+def test_parse_resource_cache():
+    parse_resource.cache_clear()
+    for i in range(10):
+        assert parse_resource('250m', 'cpu') == 250
+    assert parse_resource.cache_info().hits == 9
 
 
 def test_apply_buffer():
@@ -46,14 +79,14 @@ def test_calculate_usage_by_asg_zone():
     pod.name = 'mypod'
     pod.obj = {'status': {}, 'spec': {'nodeName': 'foo', 'containers': [{'name': 'mycont', 'resources': {'requests': {'cpu': '1m'}}}]}}
     nodes = {'foo': {'asg_name': 'asg1', 'zone': 'z1'}}
-    assert calculate_usage_by_asg_zone([pod], nodes) == {('asg1', 'z1'): {'cpu': 1/1000, 'memory': 52428800, 'pods': 1}}
+    assert calculate_usage_by_asg_zone([pod], nodes) == {('asg1', 'z1'): {'cpu': 1, 'memory': 52428800, 'pods': 1}}
 
     # pod is assigned to a node, but pending
     pod = MagicMock()
     pod.name = 'mypod'
     pod.obj = {'status': {'phase': 'Pending'}, 'spec': {'nodeName': 'foo', 'containers': [{'name': 'mycont', 'resources': {'requests': {'cpu': '1m'}}}]}}
     nodes = {}
-    assert calculate_usage_by_asg_zone([pod], nodes) == {('unknown', 'unknown'): {'cpu': 1/1000, 'memory': 52428800, 'pods': 1}}
+    assert calculate_usage_by_asg_zone([pod], nodes) == {('unknown', 'unknown'): {'cpu': 1, 'memory': 52428800, 'pods': 1}}
 
     # pod is a "ghost" --- returned by API but node no longer exists
     pod = MagicMock()
@@ -66,7 +99,7 @@ def test_calculate_usage_by_asg_zone():
     pod = MagicMock()
     pod.name = 'mypod'
     pod.obj = {'status': {'phase': 'Failed'}, 'spec': {'nodeName': 'foo', 'containers': [{'name': 'mycont', 'resources': {'requests': {'cpu': '1m'}}}]}}
-    assert calculate_usage_by_asg_zone([pod], {}) == {('unknown', 'unknown'): {'cpu': 1/1000, 'memory': 52428800, 'pods': 1}}
+    assert calculate_usage_by_asg_zone([pod], {}) == {('unknown', 'unknown'): {'cpu': 1, 'memory': 52428800, 'pods': 1}}
 
     # failed pod that won't be restarted, should not be included in the calculations
     pod = MagicMock()
@@ -75,6 +108,42 @@ def test_calculate_usage_by_asg_zone():
     assert calculate_usage_by_asg_zone([pod], {}) == {}
 
 
+def test_calculate_usage_by_asg_zone_per_node():
+    pod = MagicMock()
+    pod.obj = {'status': {}, 'spec': {'nodeName': 'foo', 'containers': [{'name': 'mycont', 'resources': {'requests': {'cpu': '1m'}}}]}}
+    nodes = {'foo': {'asg_name': 'asg1', 'zone': 'z1'}, 'bar': {'asg_name': 'asg1', 'zone': 'z1'}}
+    calculate_usage_by_asg_zone([pod, pod], nodes)
+    assert nodes['foo']['requested'] == {'cpu': 2, 'memory': 2*52428800, 'pods': 2}
+    assert 'requested' not in nodes['bar']
+
+
+def test_get_weakest_allocatable():
+    gpu_node = {'allocatable': {'cpu': 8000, 'memory': 64, 'pods': 58, 'nvidia.com/gpu': 2}}
+    # GPU device plugin did not register yet
+    new_gpu_node = {'allocatable': {'cpu': 8000, 'memory': 62, 'pods': 58, 'nvidia.com/gpu': 0}}
+    small_node = {'allocatable': {'cpu': 2000, 'memory': 16, 'pods': 29}}
+    assert get_weakest_allocatable([new_gpu_node, gpu_node]) == {'cpu': 8000, 'memory': 62, 'pods': 58, 'nvidia.com/gpu': 2}
+    assert get_weakest_allocatable([gpu_node, small_node]) == {'cpu': 2000, 'memory': 16, 'pods': 29, 'nvidia.com/gpu': 2}
+
+    usage = {('a1', 'z1'): {'cpu': 1000, 'memory': 1, 'pods': 1, 'nvidia.com/gpu': 3}}
+    for node in (gpu_node, new_gpu_node):
+        node.update(unschedulable=False, master=False)
+    assert calculate_required_auto_scaling_group_sizes({('a1', 'z1'): [new_gpu_node, gpu_node]}, usage, {}, {}) == {'a1': 2}
+
+
+def test_find_least_utilized_nodes():
+    def node(name, pods, cpu, **kwargs):
+        obj = {'name': name, 'allocatable': {'cpu': 2, 'memory': 1, 'pods': 10}, 'requested': {'cpu': cpu, 'memory': 0, 'pods': pods},
+               'ready': True, 'master': False, 'asg_lifecycle_state': 'InService'}
+        obj.update(kwargs)
+        return obj
+
+    nodes = [node('busy', 5, 1), node('empty', 0, 0), node('half', 1, 1), node('small', 1, 0.5),
+             node('notready', 0, 0, ready=False), node('terminating', 0, 0, asg_lifecycle_state='Terminating'),
+             node('cordoned', 0, 0, unschedulable=True)]
+    assert [n['name'] for n in find_least_utilized_nodes(nodes)] == ['empty', 'small', 'half', 'busy']
+
+
 def test_calculate_required_auto_scaling_group_sizes():
     assert calculate_required_auto_scaling_group_sizes({}, {}, {}, {}) == {}
     node = {'allocatable': {'cpu': 1, 'memory': 1, 'pods': 1}, 'unschedulable': False, 'master': False}
@@ -84,6 +153,79 @@ def test_calculate_required_auto_scaling_group_sizes():
     assert calculate_required_auto_scaling_group_sizes({('a1', 'z1'): [node]}, {}, {}, {}, buffer_spare_nodes=2) == {'a1': 2}
 
 
+def test_get_required_nodes():
+    assert get_required_nodes({}, {'cpu': 1}) == 0
+    assert get_required_nodes({'cpu': 0.3}, {'cpu': 0.1}) == 3
+    assert get_required_nodes({'cpu': 2.5, 'memory': 10}, {'cpu': 1, 'memory': 1}) == 10
+    # resources not provided by the node are ignored
+    assert get_required_nodes({'cpu': 1, 'nvidia.com/gpu': 1}, {'cpu': 1}) == 1
+
+
+def test_calculate_required_auto_scaling_group_sizes_extended_resources():
+    pod = MagicMock()
+    pod.obj = {'status': {}, 'spec': {'containers': [{'name': 'c', 'resources': {'requests': {'cpu': '1m', 'nvidia.com/gpu': '3'}}}]}}
+    usage = calculate_usage_by_asg_zone([pod], {})
+    assert usage == {('unknown', 'unknown'): {'cpu': 1, 'memory': 52428800, 'pods': 1, 'nvidia.com/gpu': 3}}
+
+    node = {'allocatable': {'cpu': 8000, 'memory': 32*1024**3, 'pods': 100, 'ephemeral-storage': 100*1024**3},
+            'unschedulable': False, 'master': False}
+    gpu_node = {'allocatable': {'cpu': 8000, 'memory': 32*1024**3, 'pods': 100, 'nvidia.com/gpu': 1},
+                'unschedulable': False, 'master': False}
+    nodes_by_asg_zone = {('a1', 'z1'): [node], ('gpu', 'z1'): [gpu_node]}
+    assert calculate_required_auto_scaling_group_sizes(nodes_by_asg_zone, usage, {}, {}) == {'a1': 1, 'gpu': 3}
+
+
+def test_calculate_required_auto_scaling_group_sizes_decision():
+    node = {'name': 'n1', 'allocatable': {'cpu': 1, 'memory': 1, 'pods': 1}, 'unschedulable': True, 'master': False,
+            'asg_lifecycle_state': 'InService'}
+    decision = {'zones': [], 'asgs': {}}
+    usage = {('a1', 'z1'): {'cpu': 1, 'memory': 1, 'pods': 1}}
+    assert calculate_required_auto_scaling_group_sizes({('a1', 'z1'): [node]}, usage, {}, {}, buffer_spare_nodes=1,
+                                                       disable_scale_down=True, decision=decision) == {'a1': 3}
+    record, = decision['zones']
+    assert record['asg_name'] == 'a1'
+    assert record['requested'] == {'cpu': 1, 'memory': 1, 'pods': 1}
+    assert record['compensated_nodes'] == ['n1']
+    assert record['required_nodes'] == 3
+    assert record['current_nodes'] == 1
+    assert not record['scale_down_disabled']
+    assert format_zone_decision(record)[-1] == 'a1/z1: => 3 nodes required (current: 1)'
+
+    # spare and cordoned nodes count with their capacity units
+    node['capacity_units'] = 4
+    other = dict(node, name='n2', unschedulable=False)
+    capacity_by_asg = {'a1': {'mixed': True, 'weights': {'m5.xlarge': 4}, 'allocatable': {'cpu': 0.25, 'memory': 0.25, 'pods': 0.25}}}
+    decision = {'zones': [], 'asgs': {}}
+    assert calculate_required_auto_scaling_group_sizes({('a1', 'z1'): [node, other]}, usage, {}, {}, buffer_spare_nodes=1,
+                                                       decision=decision, capacity_by_asg=capacity_by_asg) == {'a1': 12}
+    assert decision['zones'][0]['compensated_units'] == 4
+
+
+def test_evaluate_what_if(caplog):
+    nodes = [{'name': 'n{}'.format(i), 'allocatable': {'cpu': 1000, 'memory': 1024**3, 'pods': 10}, 'unschedulable': False,
+              'master': False} for i in range(4)]
+    usage = {('a1', 'z1'): {'cpu': 1500, 'memory': 1024**3, 'pods': 4}}
+    configs = [{}, {'buffer-spare-nodes': 0, 'buffer-cpu-fixed': '0', 'buffer-cpu-percentage': 0},
+               {'buffer-spare-nodes': 0, 'buffer-cpu-percentage': 100, 'buffer-memory-fixed': '1Gi'},
+               {'buffer-spare-nodes': 0, 'no-scale-down': True},
+               {'buffer-spare-nodes': 0, 'buffer-cpu-fixed': '0', 'buffer-cpu-percentage': 0, 'buffer-memory-fixed': '0',
+                'buffer-memory-percentage': 0, 'scale-down-step-fixed': 2}]
+    with caplog.at_level(logging.INFO):
+        results = evaluate_what_if({('a1', 'z1'): nodes}, usage, configs)
+    assert [result['config'] for result in results] == configs
+    # evaluating many configurations does not flood the log
+    assert 'Slowing down downscale' not in caplog.text
+    # the cluster state is not modified
+    assert usage == {('a1', 'z1'): {'cpu': 1500, 'memory': 1024**3, 'pods': 4}}
+    assert results[0]['asg_sizes'] == {'a1': 3}
+    # 2 nodes would be enough, but scale-down is slowed down to one node at a time
+    assert results[1]['asg_sizes'] == {'a1': 3}
+    assert results[1]['overprovisioned'] == {'a1/z1': {'cpu': 500, 'memory': 1024**3, 'pods': 16}}
+    assert results[2]['asg_sizes'] == {'a1': 4}
+    assert results[3]['asg_sizes'] == {'a1': 4}
+    assert results[4]['asg_sizes'] == {'a1': 2}
+
+
 def test_calculate_required_auto_scaling_group_sizes_no_scaledown():
     nodes = [{'allocatable': {'cpu': 1, 'memory': 1, 'pods': 1}, 'unschedulable': False, 'master': False},
              {'allocatable': {'cpu': 1, 'memory': 1, 'pods': 1}, 'unschedulable': False, 'master': False}]
@@ -255,6 +397,197 @@ def test_resize_auto_scaling_groups_nodes_not_ready(monkeypatch):
     autoscaling.set_desired_capacity.assert_not_called()
 
 
+def test_resize_auto_scaling_groups_terminate_least_utilized(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.scaling_activity_in_progress', lambda a, b: False)
+    drain_node = MagicMock(return_value=True)
+    monkeypatch.setattr('kube_aws_autoscaler.main.drain_node', drain_node)
+    autoscaling = MagicMock()
+    autoscaling.describe_auto_scaling_groups.return_value = {
+        'AutoScalingGroups': [{
+            'AutoScalingGroupName': 'asg1',
+            'DesiredCapacity': 2,
+            'MinSize': 1,
+            'MaxSize': 10
+        }]
+    }
+    nodes = [{'name': 'n1', 'instance_id': 'i-1', 'asg_name': 'asg1', 'zone': 'z1', 'ready': True, 'master': False,
+              'asg_lifecycle_state': 'InService', 'allocatable': {'pods': 10}, 'requested': {'pods': 3}},
+             {'name': 'n2', 'instance_id': 'i-2', 'asg_name': 'asg1', 'zone': 'z1', 'ready': True, 'master': False,
+              'asg_lifecycle_state': 'InService', 'allocatable': {'pods': 10}, 'requested': {'pods': 1}}]
+    api = MagicMock()
+    resize_auto_scaling_groups(autoscaling, {'asg1': 1}, {'asg1': 2}, api=api, nodes_by_asg={'asg1': nodes})
+    autoscaling.set_desired_capacity.assert_not_called()
+    drain_node.assert_called_once_with(api, 'n2', 120)
+    autoscaling.terminate_instance_in_auto_scaling_group.assert_called_once_with(InstanceId='i-2', ShouldDecrementDesiredCapacity=True)
+
+    # node could not be drained: uncordon it again and keep the instance
+    drain_node.return_value = False
+    autoscaling.terminate_instance_in_auto_scaling_group.reset_mock()
+    api.reset_mock()
+    resize_auto_scaling_groups(autoscaling, {'asg1': 1}, {'asg1': 2}, api=api, nodes_by_asg={'asg1': nodes})
+    autoscaling.terminate_instance_in_auto_scaling_group.assert_not_called()
+    assert api.patch.call_args_list[-1][1]['data'] == '{"spec": {"unschedulable": false}}'
+
+    # eviction or termination errors: uncordon it again, too
+    for drain_error, terminate_error in ((Exception('Forbidden'), None), (None, Exception('AWS is down'))):
+        drain_node.return_value = True
+        drain_node.side_effect = drain_error
+        autoscaling.terminate_instance_in_auto_scaling_group.side_effect = terminate_error
+        api.reset_mock()
+        resize_auto_scaling_groups(autoscaling, {'asg1': 1}, {'asg1': 2}, api=api, nodes_by_asg={'asg1': nodes})
+        assert api.patch.call_args_list[-1][1]['data'] == '{"spec": {"unschedulable": false}}'
+
+
+def test_terminate_least_utilized_nodes_capacity_units(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.drain_node', MagicMock(return_value=True))
+    nodes = [{'name': 'n{}'.format(i), 'instance_id': 'i-{}'.format(i), 'asg_name': 'asg1', 'zone': 'z1', 'ready': True,
+              'master': False, 'unschedulable': False, 'asg_lifecycle_state': 'InService', 'allocatable': {'pods': 10},
+              'requested': {'pods': i}, 'capacity_units': units} for i, units in enumerate([2, 2, 1])]
+    autoscaling = MagicMock()
+    # the least utilized node counts two units, the next one would overshoot
+    terminate_least_utilized_nodes(MagicMock(), autoscaling, nodes, 3, 120)
+    assert [call[1]['InstanceId'] for call in autoscaling.terminate_instance_in_auto_scaling_group.call_args_list] == ['i-0', 'i-2']
+
+    autoscaling.reset_mock()
+    terminate_least_utilized_nodes(MagicMock(), autoscaling, nodes, 1, 120)
+    autoscaling.terminate_instance_in_auto_scaling_group.assert_called_once_with(InstanceId='i-2', ShouldDecrementDesiredCapacity=True)
+
+
+def test_drain_node(monkeypatch):
+    daemon_set_pod = MagicMock()
+    daemon_set_pod.obj = {'metadata': {'ownerReferences': [{'kind': 'DaemonSet'}]}, 'status': {'phase': 'Running'}}
+    pod = MagicMock()
+    pod.name = 'mypod'
+    pod.namespace = 'default'
+    pod.obj = {'metadata': {}, 'status': {'phase': 'Running'}}
+    query = MagicMock()
+    query.filter.return_value.__iter__.side_effect = [iter([pod, daemon_set_pod]), iter([daemon_set_pod])]
+    monkeypatch.setattr('pykube.Pod.objects', MagicMock(return_value=query))
+    api = MagicMock()
+    api.post.return_value.status_code = 201
+    assert drain_node(api, 'n1', 60)
+    api.post.assert_called_once()
+    assert api.post.call_args[1]['url'] == 'pods/mypod/eviction'
+
+    # eviction refused by PodDisruptionBudget
+    query.filter.return_value.__iter__.side_effect = [iter([pod])]
+    api.post.return_value.status_code = 429
+    assert not drain_node(api, 'n1', 60)
+
+    # API servers before Kubernetes 1.22 only know policy/v1beta1 evictions
+    query.filter.return_value.__iter__.side_effect = [iter([pod]), iter([])]
+    api.post.reset_mock()
+    api.post.side_effect = [MagicMock(status_code=400), MagicMock(status_code=201)]
+    assert drain_node(api, 'n1', 60)
+    assert [json.loads(call[1]['data'])['apiVersion'] for call in api.post.call_args_list] == ['policy/v1', 'policy/v1beta1']
+
+
+def test_scale_up_time_to_ready(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.scaling_activity_in_progress', lambda a, b: False)
+    monkeypatch.setattr('kube_aws_autoscaler.main.SCALE_UPS', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.STATS', {})
+    autoscaling = MagicMock()
+    asg = {'AutoScalingGroupName': 'asg1', 'DesiredCapacity': 2, 'MinSize': 1, 'MaxSize': 10}
+    autoscaling.describe_auto_scaling_groups.return_value = {'AutoScalingGroups': [asg]}
+    warm_pools = {'asg1': {'min_size': 2, 'pool_state': 'Stopped', 'warmed': 2}}
+    resize_auto_scaling_groups(autoscaling, {'asg1': 5}, {'asg1': 2}, warm_pools=warm_pools)
+    autoscaling.set_desired_capacity.assert_called_with(AutoScalingGroupName='asg1', DesiredCapacity=5)
+    assert kube_aws_autoscaler.main.SCALE_UPS['asg1']['to'] == 5
+
+    report_scale_up_readiness({'asg1': 4})
+    assert 'asg1' in kube_aws_autoscaler.main.SCALE_UPS
+    report_scale_up_readiness({'asg1': 5})
+    assert 'asg1' not in kube_aws_autoscaler.main.SCALE_UPS
+    assert kube_aws_autoscaler.main.STATS['time_to_ready']['asg1'] >= 0
+
+    # scaling down before the scale-up completed drops it
+    resize_auto_scaling_groups(autoscaling, {'asg1': 5}, {'asg1': 2}, asgs={'asg1': dict(asg, DesiredCapacity=2)})
+    resize_auto_scaling_groups(autoscaling, {'asg1': 3}, {'asg1': 5}, asgs={'asg1': dict(asg, DesiredCapacity=5)})
+    assert 'asg1' not in kube_aws_autoscaler.main.SCALE_UPS
+
+
+def test_in_flight_instances(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.SCALE_UPS', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.IN_FLIGHT', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.STATS', {})
+    nodes_by_asg_zone = {('asg1', 'z1'): [{'instance_id': 'i-1'}]}
+    asgs = {'asg1': {'Instances': [{'InstanceId': 'i-1', 'LifecycleState': 'InService'},
+                                   {'InstanceId': 'i-2', 'LifecycleState': 'Pending'},
+                                   {'InstanceId': 'i-3', 'LifecycleState': 'Terminating'}]}}
+    assert get_in_flight_instances(asgs, nodes_by_asg_zone, 600) == {'asg1': 1}
+    assert set(kube_aws_autoscaler.main.IN_FLIGHT) == {'i-2'}
+
+    # instances not joining within the timeout are not counted anymore
+    kube_aws_autoscaler.main.IN_FLIGHT['i-2']['since'] -= 601
+    assert get_in_flight_instances(asgs, nodes_by_asg_zone, 600) == {}
+
+    # our own scale-up counts before the ASG reports the new instances
+    kube_aws_autoscaler.main.SCALE_UPS['asg1'] = {'started': time.time(), 'from': 1, 'to': 3}
+    assert get_in_flight_instances({'asg1': {'Instances': []}}, nodes_by_asg_zone, 600) == {'asg1': 2}
+    assert kube_aws_autoscaler.main.IN_FLIGHT == {}
+
+    asgs['asg1']['Instances'][1]['LifecycleState'] = 'InService'
+    get_in_flight_instances(asgs, nodes_by_asg_zone, 600)
+    nodes_by_asg_zone[('asg1', 'z1')].append({'instance_id': 'i-2'})
+    assert get_in_flight_instances(asgs, nodes_by_asg_zone, 600) == {'asg1': 1}
+    assert kube_aws_autoscaler.main.STATS['time_to_join']['asg1'] >= 0
+
+    # an expired scale-up is forgotten, later instances (e.g. replacements) are tracked since they are seen
+    kube_aws_autoscaler.main.SCALE_UPS['asg1'] = {'started': time.time() - 601, 'from': 1, 'to': 3}
+    asgs['asg1']['Instances'].append({'InstanceId': 'i-4', 'LifecycleState': 'Pending'})
+    assert get_in_flight_instances(asgs, nodes_by_asg_zone, 600) == {'asg1': 1}
+    assert kube_aws_autoscaler.main.SCALE_UPS == {}
+    assert kube_aws_autoscaler.main.IN_FLIGHT['i-4']['since'] > time.time() - 60
+
+
+def test_resize_auto_scaling_groups_instances_in_flight(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.scaling_activity_in_progress', lambda a, b: False)
+    autoscaling = MagicMock()
+    asgs = {'asg1': {'AutoScalingGroupName': 'asg1', 'DesiredCapacity': 3, 'MinSize': 1, 'MaxSize': 10}}
+    decision = {'asgs': {}}
+    resize_auto_scaling_groups(autoscaling, {'asg1': 1}, {'asg1': 3}, decision=decision, asgs=asgs,
+                               in_flight_by_asg={'asg1': 1})
+    autoscaling.describe_auto_scaling_groups.assert_not_called()
+    autoscaling.set_desired_capacity.assert_not_called()
+    assert decision['asgs']['asg1']['skipped'] == 'instances in flight'
+
+    resize_auto_scaling_groups(autoscaling, {'asg1': 1}, {'asg1': 3}, asgs=asgs, in_flight_by_asg={})
+    autoscaling.set_desired_capacity.assert_called_once_with(AutoScalingGroupName='asg1', DesiredCapacity=1)
+
+
+def test_warm_pools(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.SCALE_UP_HISTORY', {'asg2': [(time.time(), 4)], 'asg3': [(time.time(), 4)]})
+    autoscaling = MagicMock()
+    asgs = {'asg1': {'AutoScalingGroupName': 'asg1', 'DesiredCapacity': 5, 'WarmPoolSize': 1,
+                     'WarmPoolConfiguration': {'MinSize': 1, 'MaxGroupPreparedCapacity': 6, 'PoolState': 'Running'}},
+            'asg2': {'AutoScalingGroupName': 'asg2', 'DesiredCapacity': 2, 'Tags': [{'Key': 'kube-aws-autoscaler/warm-pool', 'Value': ''}]},
+            'asg3': {'AutoScalingGroupName': 'asg3', 'DesiredCapacity': 2, 'MixedInstancesPolicy': {},
+                     'Tags': [{'Key': 'kube-aws-autoscaler/warm-pool', 'Value': ''}]},
+            'asg4': {'AutoScalingGroupName': 'asg4', 'DesiredCapacity': 2}}
+    warm_pools = get_warm_pools(asgs)
+    assert warm_pools == {'asg1': {'min_size': 1, 'max_prepared_capacity': 6, 'pool_state': 'Running', 'warmed': 1}}
+
+    update_warm_pools(autoscaling, asgs, warm_pools, 1)
+    # asg1 already has the right size, the tagged asg2 needs a warm pool for the last scale-up of 4 instances,
+    # asg3 cannot have a warm pool and asg4 did not opt in
+    autoscaling.put_warm_pool.assert_called_once_with(AutoScalingGroupName='asg2', MinSize=4, MaxGroupPreparedCapacity=6,
+                                                      PoolState='Stopped')
+
+    # the maximum follows the desired capacity
+    autoscaling.put_warm_pool.reset_mock()
+    asgs['asg1']['DesiredCapacity'] = 7
+    update_warm_pools(autoscaling, {'asg1': asgs['asg1']}, warm_pools, 1)
+    autoscaling.put_warm_pool.assert_called_once_with(AutoScalingGroupName='asg1', MinSize=1, MaxGroupPreparedCapacity=8,
+                                                      PoolState='Running')
+
+    # failures are logged
+    autoscaling.put_warm_pool.reset_mock()
+    autoscaling.put_warm_pool.side_effect = Exception('ValidationError')
+    update_warm_pools(autoscaling, {'asg1': asgs['asg1'], 'asg2': asgs['asg2']}, warm_pools, 3)
+    assert autoscaling.put_warm_pool.call_count == 2
+    autoscaling.put_warm_pool.assert_any_call(AutoScalingGroupName='asg1', MinSize=3, MaxGroupPreparedCapacity=10, PoolState='Running')
+
+
 def test_activity_in_progress():
     autoscaling = MagicMock()
     autoscaling.describe_scaling_activities.return_value = {
@@ -276,6 +609,97 @@ def test_activity_in_progress():
     assert scaling_activity_in_progress(autoscaling, 'my-asg')
 
 
+def test_asg_cache(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.ASG_CACHE', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.SCALE_UPS', {})
+    autoscaling = MagicMock()
+    asg = {'AutoScalingGroupName': 'asg1', 'DesiredCapacity': 2, 'MinSize': 1, 'MaxSize': 10,
+           'Instances': [{'InstanceId': 'i-1', 'LifecycleState': 'InService'},
+                         {'InstanceId': 'i-2', 'LifecycleState': 'Pending'}]}
+    autoscaling.describe_auto_scaling_groups.return_value = {'AutoScalingGroups': [asg]}
+    assert get_auto_scaling_groups(autoscaling, ['asg1'], 60) == {'asg1': asg}
+    assert get_auto_scaling_groups(autoscaling, ['asg1'], 60) == {'asg1': asg}
+    autoscaling.describe_auto_scaling_groups.assert_called_once_with(AutoScalingGroupNames=['asg1'])
+
+    # the activity is derived from the instance lifecycle states
+    assert scaling_activity_in_progress(autoscaling, 'asg1')
+    asg['Instances'][1]['LifecycleState'] = 'InService'
+    assert not scaling_activity_in_progress(autoscaling, 'asg1')
+    # weighted instances count with their capacity units and may exceed the desired capacity
+    asg['DesiredCapacity'] = 3
+    asg['Instances'][1]['WeightedCapacity'] = '2'
+    assert not scaling_activity_in_progress(autoscaling, 'asg1')
+    asg['DesiredCapacity'] = 4
+    assert scaling_activity_in_progress(autoscaling, 'asg1')
+    asg['DesiredCapacity'] = 2
+    autoscaling.describe_scaling_activities.assert_not_called()
+
+    # our own change invalidates the cache
+    resize_auto_scaling_groups(autoscaling, {'asg1': 3}, {'asg1': 2}, asgs={'asg1': asg})
+    assert 'asg1' not in kube_aws_autoscaler.main.ASG_CACHE
+    get_auto_scaling_groups(autoscaling, ['asg1'], 60)
+    assert autoscaling.describe_auto_scaling_groups.call_count == 2
+
+
+def test_capacity_model(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.INSTANCE_TYPE_ALLOCATABLE', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.ASG_INSTANCE_TYPES', collections.defaultdict(set))
+    large = {'cpu': 2000, 'memory': 8 * 1024**3, 'pods': 29}
+    xlarge = {'cpu': 4000, 'memory': 16 * 1024**3, 'pods': 58}
+    nodes_by_asg_zone = {
+        ('mixed', 'z1'): [{'name': 'n1', 'instance_type': 'm5.xlarge', 'allocatable': xlarge, 'ready': True,
+                           'unschedulable': False, 'master': False}],
+        ('plain', 'z1'): [{'name': 'n2', 'instance_type': 'm5.large', 'allocatable': large, 'ready': True,
+                           'unschedulable': False, 'master': False}]}
+    mixed_policy = {'LaunchTemplate': {'Overrides': [{'InstanceType': 'm5.large', 'WeightedCapacity': '1'},
+                                                     {'InstanceType': 'm5.xlarge', 'WeightedCapacity': '2'},
+                                                     {'InstanceType': 'm4.large', 'WeightedCapacity': '1'}]},
+                    'InstancesDistribution': {'OnDemandPercentageAboveBaseCapacity': 50}}
+    asgs = {'mixed': {'AutoScalingGroupName': 'mixed', 'AvailabilityZones': ['z1'], 'MixedInstancesPolicy': mixed_policy},
+            'plain': {'AutoScalingGroupName': 'plain', 'AvailabilityZones': ['z1']},
+            'empty': {'AutoScalingGroupName': 'empty', 'AvailabilityZones': ['z1', 'z2'], 'MixedInstancesPolicy': mixed_policy},
+            'unknown': {'AutoScalingGroupName': 'unknown', 'AvailabilityZones': ['z1']}}
+    capacity_by_asg = get_capacity_model(asgs, nodes_by_asg_zone, spot_capacity_factor=0.5)
+
+    # half of the capacity is spot which only counts half, m4.large was never seen
+    assert capacity_by_asg['mixed']['weights'] == {'m5.large': 1, 'm5.xlarge': 2, 'm4.large': 1}
+    assert capacity_by_asg['mixed']['allocatable'] == {'cpu': 1500, 'memory': 6 * 1024**3, 'pods': 21.75}
+    assert capacity_by_asg['plain']['allocatable'] == large
+    assert capacity_by_asg['unknown']['allocatable'] is None
+    # the xlarge node counts twice
+    assert nodes_by_asg_zone[('mixed', 'z1')][0]['capacity_units'] == 2
+    # ASGs without nodes are sized per AZ
+    assert nodes_by_asg_zone[('empty', 'z2')] == []
+
+    usage_by_asg_zone = {('unknown', 'unknown'): {'cpu': 2000, 'memory': 1024**3, 'pods': 1}}
+    asg_size = calculate_required_auto_scaling_group_sizes(nodes_by_asg_zone, usage_by_asg_zone, {'cpu': 10}, {'cpu': 200},
+                                                           buffer_spare_nodes=1, capacity_by_asg=capacity_by_asg)
+    # the pending pod is served by the ASGs with nodes, the spare node of the mixed ASG is its xlarge node (2 units),
+    # the empty ASG gets neither buffer nor spare nodes, the ASG without known instance types is skipped
+    assert asg_size == {'mixed': 4, 'plain': 3, 'empty': 0}
+
+    kube_aws_autoscaler.main.INSTANCE_TYPE_ALLOCATABLE['p3.2xlarge'] = {'cpu': 8000, 'memory': 60 * 1024**3, 'pods': 58, 'nvidia.com/gpu': 1}
+    asgs['gpu'] = {'AutoScalingGroupName': 'gpu', 'AvailabilityZones': ['z1', 'z2'],
+                   'MixedInstancesPolicy': {'LaunchTemplate': {'Overrides': [{'InstanceType': 'p3.2xlarge'}]}}}
+    capacity_by_asg = get_capacity_model(asgs, nodes_by_asg_zone)
+    pending_requests = [{'cpu': 1000, 'memory': 1024**3, 'pods': 1}, {'cpu': 1000, 'memory': 1024**3, 'pods': 1, 'nvidia.com/gpu': 2}]
+    asg_size = calculate_required_auto_scaling_group_sizes(nodes_by_asg_zone, usage_by_asg_zone, {}, {}, buffer_spare_nodes=1,
+                                                           capacity_by_asg=capacity_by_asg, pending_requests=pending_requests)
+    # only the GPU pod starts the GPU ASG, once for both AZs (plus one spare node)
+    assert asg_size['gpu'] == 3
+    assert asg_size['empty'] == 0
+
+
+def test_discover_auto_scaling_groups():
+    autoscaling = MagicMock()
+    autoscaling.meta.region_name = 'eu-central-1'
+    autoscaling.describe_auto_scaling_groups.side_effect = [
+        {'AutoScalingGroups': [{'AutoScalingGroupName': 'a1'}], 'NextToken': 't'},
+        {'AutoScalingGroups': [{'AutoScalingGroupName': 'a2'}]}]
+    assert discover_auto_scaling_groups(autoscaling, 'my-tag') == {'a1': 'eu-central-1', 'a2': 'eu-central-1'}
+    autoscaling.describe_auto_scaling_groups.assert_called_with(Filters=[{'Name': 'tag-key', 'Values': ['my-tag']}], NextToken='t')
+
+
 def test_get_nodes(monkeypatch):
     node = MagicMock()
     node.name = 'n1'
@@ -285,7 +709,7 @@ def test_get_nodes(monkeypatch):
         'beta.kubernetes.io/instance-type': 'x1.mega'
     }
     node.obj = {
-        'status': {'allocatable': {'cpu': '2', 'memory': '16Gi', 'pods': '10'}},
+        'status': {'allocatable': {'cpu': '2', 'memory': '16Gi', 'pods': '10'}, 'nodeInfo': {'kubeletVersion': 'v1.10.3'}},
         'spec': {'externalID': 'i-123'}
     }
 
@@ -298,7 +722,7 @@ def test_get_nodes(monkeypatch):
         'master': 'true'
     }
     master.obj = {
-        'status': {'allocatable': {'cpu': '2', 'memory': '16Gi', 'pods': '10'}},
+        'status': {'allocatable': {'cpu': '2', 'memory': '16Gi', 'pods': '10'}, 'nodeInfo': {'kubeletVersion': 'v1.10.3'}},
         'spec': {'externalID': 'i-456'}
     }
 
@@ -309,7 +733,7 @@ def test_get_nodes(monkeypatch):
     assert get_nodes(api) == {'n1': {
         'name': 'n1',
         'region': 'eu-north-1', 'zone': 'eu-north-1a', 'instance_id': 'i-123', 'instance_type': 'x1.mega',
-        'allocatable': {'cpu': 2, 'memory': 16*1024*1024*1024, 'pods': 10},
+        'allocatable': {'cpu': 2000, 'memory': 16*1024*1024*1024, 'pods': 10},
         'ready': False,
         'unschedulable': False,
         'master': False}}
@@ -317,19 +741,60 @@ def test_get_nodes(monkeypatch):
     assert get_nodes(api, include_master_nodes=True) == {'n1': {
         'name': 'n1',
         'region': 'eu-north-1', 'zone': 'eu-north-1a', 'instance_id': 'i-123', 'instance_type': 'x1.mega',
-        'allocatable': {'cpu': 2, 'memory': 16*1024*1024*1024, 'pods': 10},
+        'allocatable': {'cpu': 2000, 'memory': 16*1024*1024*1024, 'pods': 10},
         'ready': False,
         'unschedulable': False,
         'master': False}, 'master': {
             'name': 'master',
             'region': 'eu-north-1', 'zone': 'eu-north-1a', 'instance_id': 'i-456', 'instance_type': 'a1.small',
-            'allocatable': {'cpu': 2, 'memory': 16*1024*1024*1024, 'pods': 10},
+            'allocatable': {'cpu': 2000, 'memory': 16*1024*1024*1024, 'pods': 10},
             'ready': False,
             'unschedulable': False,
             'master': True
          }}
 
 
+def test_get_nodes_cache(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.NODE_CACHE', {})
+
+    def make_node(name, resource_version, cpu):
+        node = MagicMock()
+        node.name = name
+        node.labels = {
+            'failure-domain.beta.kubernetes.io/region': 'eu-north-1',
+            'failure-domain.beta.kubernetes.io/zone': 'eu-north-1a',
+            'beta.kubernetes.io/instance-type': 'x1.mega'
+        }
+        node.obj = {
+            'metadata': {'resourceVersion': resource_version},
+            'status': {'allocatable': {'cpu': cpu, 'memory': '16Gi', 'pods': '10'}, 'nodeInfo': {'kubeletVersion': 'v1.11.0'}},
+            'spec': {'providerID': 'aws:///eu-north-1a/i-{}'.format(name)}
+        }
+        return node
+
+    objects = MagicMock()
+    monkeypatch.setattr('pykube.Node.objects', objects)
+    parse_node = MagicMock(side_effect=kube_aws_autoscaler.main.parse_node)
+    monkeypatch.setattr('kube_aws_autoscaler.main.parse_node', parse_node)
+
+    objects.return_value = [make_node('n1', '1', '2'), make_node('n2', '1', '2')]
+    nodes = get_nodes(MagicMock())
+    assert nodes['n1']['instance_id'] == 'i-n1'
+    assert parse_node.call_count == 2
+    # annotations of a loop must not leak into the cache
+    nodes['n1']['asg_name'] = 'asg1'
+
+    objects.return_value = [make_node('n1', '1', '2'), make_node('n2', '2', '4')]
+    nodes = get_nodes(MagicMock())
+    assert parse_node.call_count == 3
+    assert 'asg_name' not in nodes['n1']
+    assert nodes['n2']['allocatable']['cpu'] == 4000
+
+    objects.return_value = [make_node('n2', '2', '4')]
+    assert list(get_nodes(MagicMock())) == ['n2']
+    assert list(kube_aws_autoscaler.main.NODE_CACHE) == ['n2']
+
+
 def test_get_kube_api(monkeypatch):
     kube_config = MagicMock()
     kube_config.from_service_account.side_effect = FileNotFoundError
@@ -345,7 +810,7 @@ def test_autoscale(monkeypatch):
     get_nodes.return_value = {'n1': {
                 'name': 'n1',
                 'region': 'eu-north-1', 'zone': 'eu-north-1a', 'instance_id': 'i-123', 'instance_type': 'x1.mega',
-                'allocatable': {'cpu': 2, 'memory': 16*1024*1024*1024, 'pods': 10},
+                'allocatable': {'cpu': 2000, 'memory': 16*1024*1024*1024, 'pods': 10},
                 'ready': True,
                 'unschedulable': False,
                 'master': False}}
@@ -363,6 +828,7 @@ def test_autoscale(monkeypatch):
     monkeypatch.setattr('pykube.Pod.objects', get_pods)
     monkeypatch.setattr('kube_aws_autoscaler.main.get_nodes', get_nodes)
     monkeypatch.setattr('boto3.client', boto3_client)
+    monkeypatch.setattr('kube_aws_autoscaler.main.AUTOSCALING_CLIENTS', {})
 
     buffer_percentage = {}
     buffer_fixed = {}
@@ -370,13 +836,148 @@ def test_autoscale(monkeypatch):
     boto3_client.return_value.set_desired_capacity.assert_called_with(AutoScalingGroupName='a1', DesiredCapacity=2)
 
 
+def test_autoscale_multiple_regions(monkeypatch):
+    nodes = {}
+    clients = {}
+    for i, region in enumerate(['eu-central-1', 'us-east-1']):
+        nodes['n{}'.format(i)] = {
+            'name': 'n{}'.format(i), 'region': region, 'zone': region + 'a', 'instance_id': 'i-{}'.format(i),
+            'instance_type': 'x1.mega', 'allocatable': {'cpu': 2000, 'memory': 16*1024*1024*1024, 'pods': 10},
+            'ready': True, 'unschedulable': False, 'master': False}
+        client = clients[region] = MagicMock()
+        client.describe_auto_scaling_instances.return_value = {'AutoScalingInstances': [
+            {'InstanceId': 'i-{}'.format(i), 'AutoScalingGroupName': 'a{}'.format(i), 'AvailabilityZone': region + 'a',
+             'LifecycleState': 'InService'}]}
+        client.describe_auto_scaling_groups.return_value = {'AutoScalingGroups': [
+            {'AutoScalingGroupName': 'a{}'.format(i), 'DesiredCapacity': 1, 'MinSize': 1, 'MaxSize': 10}]}
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_kube_api', MagicMock())
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_nodes', MagicMock(return_value=nodes))
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_pods', MagicMock(return_value=[]))
+    monkeypatch.setattr('kube_aws_autoscaler.main.AUTOSCALING_CLIENTS', {})
+    boto3_client = MagicMock(side_effect=lambda service, region: clients[region])
+    monkeypatch.setattr('boto3.client', boto3_client)
+
+    monkeypatch.setattr('kube_aws_autoscaler.main.SCALE_UPS', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.IN_FLIGHT', {})
+    autoscale({}, {}, 1, 0.0, buffer_spare_nodes=2)
+    autoscale({}, {}, 1, 0.0, buffer_spare_nodes=2)
+    # one client per region, reused by the second loop
+    assert boto3_client.call_count == 2
+    for i, region in enumerate(['eu-central-1', 'us-east-1']):
+        clients[region].describe_auto_scaling_groups.assert_called_with(AutoScalingGroupNames=['a{}'.format(i)])
+        clients[region].set_desired_capacity.assert_called_with(AutoScalingGroupName='a{}'.format(i), DesiredCapacity=2)
+
+
+def test_autoscale_from_zero(monkeypatch):
+    node = {'name': 'n1', 'region': 'eu-central-1', 'zone': 'z1', 'instance_id': 'i-1', 'instance_type': 'm5.large',
+            'allocatable': {'cpu': 2000, 'memory': 8 * 1024**3, 'pods': 29}, 'ready': True, 'unschedulable': False, 'master': False}
+    pending = MagicMock()
+    pending.obj = {'status': {'phase': 'Pending'}, 'spec': {'containers': [{'name': 'c1', 'resources': {'requests': {'cpu': '1'}}}]}}
+    client = MagicMock()
+    client.meta.region_name = 'eu-central-1'
+    client.describe_auto_scaling_instances.return_value = {'AutoScalingInstances': [
+        {'InstanceId': 'i-1', 'AutoScalingGroupName': 'a1', 'AvailabilityZone': 'z1', 'LifecycleState': 'InService'}]}
+    asgs = [{'AutoScalingGroupName': 'a1', 'DesiredCapacity': 1, 'MinSize': 0, 'MaxSize': 10, 'AvailabilityZones': ['z1']},
+            {'AutoScalingGroupName': 'spot', 'DesiredCapacity': 0, 'MinSize': 0, 'MaxSize': 10, 'AvailabilityZones': ['z1'],
+             'MixedInstancesPolicy': {'LaunchTemplate': {'Overrides': [{'InstanceType': 'm5.large'}]}}}]
+    client.describe_auto_scaling_groups.side_effect = lambda **kwargs: {'AutoScalingGroups': [
+        asg for asg in asgs if 'Filters' in kwargs or asg['AutoScalingGroupName'] in kwargs['AutoScalingGroupNames']]}
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_kube_api', MagicMock())
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_nodes', MagicMock(return_value={'n1': node}))
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_pods', MagicMock(return_value=[pending]))
+    monkeypatch.setattr('kube_aws_autoscaler.main.AUTOSCALING_CLIENTS', {'eu-central-1': client})
+    monkeypatch.setattr('kube_aws_autoscaler.main.ASG_CACHE', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.SCALE_UPS', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.IN_FLIGHT', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.INSTANCE_TYPE_ALLOCATABLE', {})
+
+    monkeypatch.setattr('kube_aws_autoscaler.main.CLUSTER_STATE', {})
+
+    autoscale({}, {'cpu': 200}, 1, 0.0, buffer_spare_nodes=1, discover_asg_tag='k8s.io/cluster-autoscaler/enabled')
+    # the pending pod is served by the ASG with nodes, the empty spot ASG stays at zero
+    assert [call[1]['AutoScalingGroupName'] for call in client.set_desired_capacity.call_args_list] == ['a1']
+    # the state for what-if analysis includes the capacity model and the AZs of ASGs without nodes
+    state = kube_aws_autoscaler.main.CLUSTER_STATE
+    assert sorted(state['nodes_by_asg_zone']) == [('a1', 'z1'), ('spot', 'z1')]
+    assert sorted(state['capacity_by_asg']) == ['a1', 'spot']
+    assert len(state['pending_requests']) == 1
+
+    # a pod requesting GPUs only the empty ASG provides starts it
+    monkeypatch.setattr('kube_aws_autoscaler.main.INSTANCE_TYPE_ALLOCATABLE',
+                        {'p3.2xlarge': {'cpu': 8000, 'memory': 60 * 1024**3, 'pods': 58, 'nvidia.com/gpu': 1}})
+    asgs[1]['MixedInstancesPolicy']['LaunchTemplate']['Overrides'] = [{'InstanceType': 'p3.2xlarge'}]
+    pending.obj['spec']['containers'][0]['resources']['requests']['nvidia.com/gpu'] = '1'
+    autoscale({}, {'cpu': 200}, 1, 0.0, buffer_spare_nodes=1, discover_asg_tag='k8s.io/cluster-autoscaler/enabled')
+    client.set_desired_capacity.assert_called_with(AutoScalingGroupName='spot', DesiredCapacity=2)
+
+
+def test_autoscale_fake_apis(monkeypatch, tmpdir):
+    cluster = FakeCluster(nodes=60, pods_per_node=2, asgs=55, zones=1)
+    # one pending pod which needs a new node
+    cluster.add_pod('default', 'pending', requests={'cpu': '7', 'memory': '1Gi'})
+    kube_server = start_server(FakeKubernetesHandler, cluster)
+    autoscaling_server = start_server(FakeAutoScalingHandler, cluster, throttle_rate=0.1)
+    try:
+        for key, val in get_environment(kube_server, autoscaling_server, str(tmpdir.join('kubeconfig'))).items():
+            monkeypatch.setenv(key, val)
+        monkeypatch.setattr('kube_aws_autoscaler.main.NODE_CACHE', {})
+        monkeypatch.setattr('kube_aws_autoscaler.main.AUTOSCALING_CLIENTS', {})
+        autoscale({}, {}, 1, 0.0, buffer_spare_nodes=0)
+    finally:
+        kube_server.shutdown()
+        autoscaling_server.shutdown()
+    # more than one page of ASGs
+    assert autoscaling_server.requests['DescribeAutoScalingGroups'] >= 2
+    # the pending pod fits on a single node of every ASG, i.e. the 5 ASGs with two nodes are scaled down
+    assert sorted(cluster.set_desired_capacity_calls) == [('asg-{}'.format(i), 1) for i in range(5)]
+
+
+def test_autoscale_fake_apis_asg_cache(monkeypatch, tmpdir):
+    cluster = FakeCluster(nodes=60, pods_per_node=2, asgs=55, zones=1)
+    kube_server = start_server(FakeKubernetesHandler, cluster)
+    autoscaling_server = start_server(FakeAutoScalingHandler, cluster)
+    try:
+        for key, val in get_environment(kube_server, autoscaling_server, str(tmpdir.join('kubeconfig'))).items():
+            monkeypatch.setenv(key, val)
+        monkeypatch.setattr('kube_aws_autoscaler.main.NODE_CACHE', {})
+        monkeypatch.setattr('kube_aws_autoscaler.main.AUTOSCALING_CLIENTS', {})
+        monkeypatch.setattr('kube_aws_autoscaler.main.ASG_CACHE', {})
+        autoscale({}, {}, 1, 0.0, buffer_spare_nodes=0, asg_cache_ttl=300)
+        first_loop = autoscaling_server.requests['DescribeAutoScalingGroups']
+        autoscale({}, {}, 1, 0.0, buffer_spare_nodes=0, asg_cache_ttl=300)
+    finally:
+        kube_server.shutdown()
+        autoscaling_server.shutdown()
+    assert first_loop == 2
+    # only the 5 scaled down ASGs are described again (in one request)
+    assert autoscaling_server.requests['DescribeAutoScalingGroups'] == 3
+    assert autoscaling_server.requests['DescribeScalingActivities'] == 0
+
+
+def test_get_pods_by_namespace(monkeypatch, tmpdir):
+    cluster = FakeCluster(nodes=20, pods_per_node=5, namespaces=7)
+    kube_server = start_server(FakeKubernetesHandler, cluster)
+    try:
+        monkeypatch.setenv('KUBECONFIG', str(tmpdir.join('kubeconfig')))
+        write_kubeconfig(str(tmpdir.join('kubeconfig')), kube_server)
+        api = get_kube_api()
+        pods = sorted((pod.namespace, pod.name) for pod in get_pods(api, concurrency=3))
+        assert pods == sorted((pod.namespace, pod.name) for pod in get_pods(api))
+        assert len(pods) == 100
+    finally:
+        kube_server.shutdown()
+    assert kube_server.requests['/api/v1/pods'] == 1
+    assert kube_server.requests['/api/v1/namespaces'] == 1
+    assert sum(count for path, count in kube_server.requests.items() if path.endswith('/pods')) == 8
+
+
 def test_autoscale_node_without_asg(monkeypatch):
     kube_config = MagicMock()
     get_nodes = MagicMock()
     get_nodes.return_value = {'n1': {
                 'name': 'n1',
                 'region': 'eu-north-1', 'zone': 'eu-north-1a', 'instance_id': 'i-123', 'instance_type': 'x1.mega',
-                'allocatable': {'cpu': 2, 'memory': 16*1024*1024*1024, 'pods': 10},
+                'allocatable': {'cpu': 2000, 'memory': 16*1024*1024*1024, 'pods': 10},
                 'ready': True,
                 'unschedulable': False,
                 'master': False}}
@@ -392,12 +993,59 @@ def test_autoscale_node_without_asg(monkeypatch):
     monkeypatch.setattr('pykube.Pod.objects', get_pods)
     monkeypatch.setattr('kube_aws_autoscaler.main.get_nodes', get_nodes)
     monkeypatch.setattr('boto3.client', boto3_client)
+    monkeypatch.setattr('kube_aws_autoscaler.main.AUTOSCALING_CLIENTS', {})
 
     buffer_percentage = {}
     buffer_fixed = {}
     autoscale(buffer_percentage, buffer_fixed, 1, 0.0, False)
 
 
+def test_get_asg_owner():
+    assert get_asg_owner('asg1', ['r1']) == 'r1'
+    asg_names = ['asg{}'.format(i) for i in range(100)]
+    owners = {asg_name: get_asg_owner(asg_name, ['r1', 'r2', 'r3']) for asg_name in asg_names}
+    assert set(owners.values()) == {'r1', 'r2', 'r3'}
+    # only ASGs of the leaving replica are moved
+    for asg_name in asg_names:
+        if owners[asg_name] != 'r3':
+            assert get_asg_owner(asg_name, ['r1', 'r2']) == owners[asg_name]
+
+
+def test_get_shard_members():
+    api = MagicMock()
+    api.put.return_value.status_code = 404
+    now = datetime.datetime.utcnow()
+    api.get.return_value.json.return_value = {'items': [
+        {'spec': {'holderIdentity': 'r2', 'leaseDurationSeconds': 60,
+                  'renewTime': now.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}},
+        {'spec': {'holderIdentity': 'expired', 'leaseDurationSeconds': 60,
+                  'renewTime': (now - datetime.timedelta(seconds=61)).strftime('%Y-%m-%dT%H:%M:%S.%fZ')}}
+    ]}
+    assert get_shard_members(api, 'default', 'r1', 60) == ['r1', 'r2']
+    api.post.assert_called_once()
+    assert api.post.call_args[1]['version'] == 'coordination.k8s.io/v1'
+    assert json.loads(api.post.call_args[1]['data'])['spec']['holderIdentity'] == 'r1'
+
+
+def test_autoscale_sharded(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_kube_api', MagicMock())
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_nodes', MagicMock(return_value={'n1': {'region': 'eu-north-1'}}))
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_nodes_by_asg_zone', MagicMock(return_value={}))
+    monkeypatch.setattr('kube_aws_autoscaler.main.calculate_usage_by_asg_zone', MagicMock(return_value={}))
+    monkeypatch.setattr('kube_aws_autoscaler.main.calculate_required_auto_scaling_group_sizes',
+                        MagicMock(return_value={'asg1': 1, 'asg2': 1, 'asg3': 1}))
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_shard_members', MagicMock(return_value=['r1', 'r2']))
+    monkeypatch.setattr('pykube.Pod.objects', MagicMock())
+    monkeypatch.setattr('boto3.client', MagicMock())
+    monkeypatch.setattr('kube_aws_autoscaler.main.AUTOSCALING_CLIENTS', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_auto_scaling_groups', MagicMock(return_value={}))
+    resize = MagicMock()
+    monkeypatch.setattr('kube_aws_autoscaler.main.resize_auto_scaling_groups', resize)
+    autoscale({}, {}, 1, 0.0, shard_identity='r1')
+    asg_size = resize.call_args[0][1]
+    assert sorted(asg_size) == sorted(asg_name for asg_name in ['asg1', 'asg2', 'asg3'] if get_asg_owner(asg_name, ['r1', 'r2']) == 'r1')
+
+
 def test_main(monkeypatch):
     autoscale = MagicMock()
     monkeypatch.setattr('kube_aws_autoscaler.main.autoscale', autoscale)
@@ -405,9 +1053,13 @@ def test_main(monkeypatch):
     main()
     autoscale.assert_called_once_with(
         {'memory': 10, 'pods': 10, 'cpu': 10},
-        {'memory': 209715200, 'pods': 10, 'cpu': 0.2},
+        {'memory': 209715200, 'pods': 10, 'cpu': 200},
         buffer_spare_nodes=1, include_master_nodes=False, dry_run=True, disable_scale_down=False,
-        scale_down_step_fixed=1, scale_down_step_percentage=0.0
+        scale_down_step_fixed=1, scale_down_step_percentage=0.0,
+        terminate_least_utilized=False, drain_timeout=120, warm_pool_min_size=None,
+        shard_identity=None, shard_namespace='default', shard_lease_duration=180,
+        pod_list_concurrency=0, join_timeout=600, asg_cache_ttl=0, metrics_db=None,
+        placeholder_namespace=None, discover_asg_tag=None, spot_capacity_factor=1.0
     )
 
     autoscale.side_effect = ValueError
@@ -417,6 +1069,26 @@ def test_main(monkeypatch):
     with pytest.raises(Exception):
         main()
 
+
+def test_main_profile(monkeypatch, tmpdir):
+    monkeypatch.setattr('kube_aws_autoscaler.main.Healthy', False)
+    autoscale = MagicMock()
+    monkeypatch.setattr('kube_aws_autoscaler.main.autoscale', autoscale)
+    monkeypatch.setattr('sys.argv', ['foo', '--once', '--dry-run', '--profile=1', '--profile-directory={}'.format(tmpdir)])
+    main()
+    autoscale.assert_called_once()
+    assert kube_aws_autoscaler.main.PROFILE['iterations'] == 0
+    assert len(tmpdir.listdir(lambda p: p.ext == '.prof')) == 1
+
+
+def test_run_profiled(tmpdir):
+    assert run_profiled(lambda a, b: [a] * b, str(tmpdir), 'x', b=3) == ['x', 'x', 'x']
+    names = sorted(p.basename for p in tmpdir.listdir())
+    assert len(names) == 2
+    assert names[0].endswith('-allocations.txt')
+    assert names[1].endswith('.prof')
+
+
 def test_main_step_down(monkeypatch):
     monkeypatch.setattr('sys.argv', ['foo', '--once', '--dry-run', '--scale-down-step-fixed=0'])
     with pytest.raises(ValueError) as err:
@@ -440,10 +1112,13 @@ def test_main_step_down(monkeypatch):
 
 
 def test_format_resource():
-    assert format_resource(1, 'cpu') == '1.0'
+    assert format_resource(1000, 'cpu') == '1.0'
+    assert format_resource(250, 'cpu') == '0.2'
     assert format_resource(1024*1024, 'memory') == '1Mi'
     assert format_resource(1, 'pods') == '1'
     assert format_resource(1, 'foo') == '1'
+    assert format_resource(1024*1024, 'ephemeral-storage') == '1Mi'
+    assert format_resource(2, 'nvidia.com/gpu') == '2'
 
 
 def test_slow_down_downscale():
@@ -471,6 +1146,9 @@ def test_slow_down_downscale():
     assert slow_down_downscale({'a1': 1}, {('a1', 'z1'): [{}, {}, {}], ('a1', 'z2'): [{}, {}]}, 1, 0.0) == {'a1': 4}
     assert slow_down_downscale({'a1': 1}, {('a1', 'z1'): [{}, {}, {}], ('a1', 'z2'): [{}, {}, {}]}, 1, 0.0) == {'a1': 5}
 
+    # instances which did not join yet count as current size
+    assert slow_down_downscale({'a1': 1}, {('a1', 'z1'): [{}, {}]}, 1, 0.0, in_flight_by_asg={'a1': 2}) == {'a1': 3}
+
     # test with 1 step fixed and 1% step percentage (same as above)
     assert slow_down_downscale({'a1': 1}, {('a1', 'z1'): [{}]}, 1, 0.01) == {'a1': 1}
     assert slow_down_downscale({'a1': 1}, {('a1', 'z1'): [{}, {}]}, 1, 0.01) == {'a1': 1}
@@ -489,6 +1167,36 @@ def test_slow_down_downscale():
     assert slow_down_downscale({'a1': 1}, {('a1', 'z1'): [{}, {}, {}], ('a1', 'z2'): [{}, {}]}, 1, 0.5) == {'a1': 3}
     assert slow_down_downscale({'a1': 1}, {('a1', 'z1'): [{}, {}, {}], ('a1', 'z2'): [{}, {}, {}]}, 1, 0.5) == {'a1': 3}
 
+    decision = {'asgs': {}}
+    slow_down_downscale({'a1': 1, 'a2': 1}, {('a1', 'z1'): [{}, {}, {}], ('a2', 'z1'): [{}]}, 1, 0.0, decision)
+    assert decision['asgs'] == {'a1': {'slowed_down': {'from': 1, 'to': 2}}}
+
+
+def test_slow_down_downscale_capacity_units(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.scaling_activity_in_progress', lambda a, b: False)
+    monkeypatch.setattr('kube_aws_autoscaler.main.drain_node', MagicMock(return_value=True))
+    nodes = [{'name': 'n{}'.format(i), 'instance_id': 'i-{}'.format(i), 'asg_name': 'a1', 'zone': 'z1', 'ready': True,
+              'master': False, 'unschedulable': False, 'asg_lifecycle_state': 'InService', 'allocatable': {'pods': 10},
+              'requested': {'pods': i}, 'capacity_units': 4} for i in range(3)]
+    # the step is one whole node, i.e. 4 units
+    assert slow_down_downscale({'a1': 2}, {('a1', 'z1'): nodes}, 1, 0.0) == {'a1': 8}
+    # a node can only be removed if the remaining ones still provide the desired capacity
+    assert slow_down_downscale({'a1': 5}, {('a1', 'z1'): nodes}, 1, 0.0) == {'a1': 8}
+    assert slow_down_downscale({'a1': 9}, {('a1', 'z1'): nodes}, 1, 0.0) == {'a1': 12}
+
+    autoscaling = MagicMock()
+    autoscaling.terminate_instance_in_auto_scaling_group.side_effect = lambda InstanceId, **kwargs: nodes.remove(
+        next(node for node in nodes if node['instance_id'] == InstanceId))
+    sizes = []
+    for _ in range(4):
+        asg_size = slow_down_downscale({'a1': 2}, {('a1', 'z1'): nodes}, 1, 0.0)
+        asgs = {'a1': {'AutoScalingGroupName': 'a1', 'DesiredCapacity': 4 * len(nodes), 'MinSize': 0, 'MaxSize': 20}}
+        resize_auto_scaling_groups(autoscaling, asg_size, {'a1': 4 * len(nodes)}, api=MagicMock(),
+                                   nodes_by_asg={'a1': list(nodes)}, asgs=asgs)
+        sizes.append(4 * len(nodes))
+    # one node per loop until the last node (more than the 2 required units) is left
+    assert sizes == [8, 4, 4, 4]
+
 
 def test_is_node_ready():
     node = MagicMock()
@@ -508,11 +1216,172 @@ def test_chunks():
 
 
 def test_start_health_endpoint():
-    flask = app.test_client()
+    flask = get_app().test_client()
     flask.testing = True
     response = flask.get('/healthz')
     assert response.status_code == 503
 
+
+def test_decisions_endpoint(monkeypatch):
+    decisions = collections.deque([{'timestamp': 1}, {'timestamp': 2}], maxlen=10)
+    monkeypatch.setattr('kube_aws_autoscaler.main.DECISIONS', decisions)
+    flask = get_app().test_client()
+    assert flask.get('/decisions').get_json() == [{'timestamp': 1}, {'timestamp': 2}]
+    assert flask.get('/decisions?limit=1').get_json() == [{'timestamp': 2}]
+
+
+def test_metrics_history(monkeypatch, tmpdir):
+    monkeypatch.setattr('kube_aws_autoscaler.main.METRICS', {'path': None, 'connection': None, 'maintained': 0})
+    monkeypatch.setattr('kube_aws_autoscaler.main.METRICS_DB_MAX_ROWS', 20)
+    flask = get_app().test_client()
+    assert flask.get('/history').status_code == 404
+
+    def decision(timestamp, requested_cpu):
+        zone = {'asg_name': 'a1', 'zone': 'z1', 'resources': ['cpu'], 'requested': {'cpu': requested_cpu},
+                'with_buffer': {'cpu': requested_cpu * 2}, 'required_nodes': 2, 'current_nodes': 1}
+        return {'timestamp': timestamp, 'zones': [zone], 'asgs': {'a1': {'required': 2, 'new': 2}}}
+
+    path = str(tmpdir.join('metrics.db'))
+    now = 1000 * 3600
+    # two loops two days ago, maintenance only runs once per hour
+    record_metrics(path, decision(now - 48 * 3600, 100))
+    record_metrics(path, decision(now - 48 * 3600 + 60, 300))
+    response = flask.get('/history?metric=requested.cpu')
+    assert [(row['timestamp'], row['resolution'], row['value']) for row in response.get_json()] == [
+        (now - 48 * 3600, 0, 100), (now - 48 * 3600 + 60, 0, 300)]
+
+    record_metrics(path, decision(now, 500))
+    response = flask.get('/history?metric=requested.cpu&asg=a1&zone=z1')
+    assert [(row['timestamp'], row['resolution'], row['value']) for row in response.get_json()] == [
+        (now - 48 * 3600, 3600, 200), (now, 0, 500)]
+    assert flask.get('/history?asg=a1&zone=&metric=desired_capacity&since={}'.format(now)).get_json() == [
+        {'timestamp': now, 'resolution': 0, 'asg_name': 'a1', 'zone': '', 'metric': 'desired_capacity', 'value': 2}]
+    assert flask.get('/history?since=foo').status_code == 400
+    assert flask.get('/history?limit=-1').status_code == 400
+    assert flask.get('/history?limit=0').status_code == 400
+
+    # the oldest rows are dropped above the row limit
+    for i in range(1, 4):
+        record_metrics(path, decision(now + i * 3600, 500))
+    rows = flask.get('/history').get_json()
+    assert len(rows) == 20
+    assert rows[0]['timestamp'] == now
+
+
+def test_placeholder_pods():
+    nodes_by_asg_zone = {('a1', 'z1'): [{'name': 'n1', 'instance_type': 'm5.large', 'allocatable': {'cpu': 2000, 'memory': 8 * 1024**3, 'pods': 110}}],
+                         ('a2', 'z1'): [{'name': 'n2', 'instance_type': 'm5.large', 'allocatable': {'cpu': 2000, 'memory': 8 * 1024**3, 'pods': 110}}]}
+    records = [{'asg_name': 'a1', 'zone': 'z1', 'weakest_node': {'cpu': 2000, 'memory': 8 * 1024**3},
+                'requested': {'cpu': 1000, 'memory': 1024**3}, 'with_buffer': {'cpu': 3450, 'memory': 1.5 * 1024**3}},
+               {'asg_name': 'a2', 'zone': 'z1', 'weakest_node': {'cpu': 2000, 'memory': 8 * 1024**3},
+                'requested': {'cpu': 1000, 'memory': 1024**3}, 'with_buffer': {'cpu': 1000, 'memory': 1024**3}}]
+    pods = get_placeholder_pods(records, nodes_by_asg_zone, 'ns')
+    # the CPU buffer of 2450m needs three pods (at most half of the node each)
+    assert len(pods) == 3
+    for name, pod in pods.items():
+        assert pod['metadata']['name'] == name
+        assert pod['metadata']['labels'] == {'kube-aws-autoscaler/placeholder': 'true'}
+        assert pod['metadata']['annotations'] == {'kube-aws-autoscaler/asg': 'a1', 'kube-aws-autoscaler/zone': 'z1'}
+        assert pod['spec']['nodeSelector'] == {'failure-domain.beta.kubernetes.io/zone': 'z1', 'beta.kubernetes.io/instance-type': 'm5.large'}
+        assert pod['spec']['containers'][0]['resources']['requests'] == {'cpu': '900m', 'memory': str(256 * 1024**2)}
+    # same buffer, same pods
+    assert get_placeholder_pods(records, nodes_by_asg_zone, 'ns') == pods
+
+    # placeholders do not count as demand
+    pod = MagicMock()
+    pod.obj = dict(pods[sorted(pods)[0]], status={'phase': 'Running'})
+    pod.obj['spec'] = dict(pod.obj['spec'], nodeName='n1')
+    assert calculate_usage_by_asg_zone([pod], {'n1': dict(nodes_by_asg_zone[('a1', 'z1')][0], asg_name='a1', zone='z1')}) == {}
+
+
+def test_reconcile_placeholder_pods():
+    api = MagicMock()
+    existing = [{'metadata': {'name': 'placeholder-old', 'annotations': {'kube-aws-autoscaler/asg': 'a1'}}},
+                {'metadata': {'name': 'placeholder-keep', 'annotations': {'kube-aws-autoscaler/asg': 'a1'}}},
+                {'metadata': {'name': 'placeholder-other-shard', 'annotations': {'kube-aws-autoscaler/asg': 'a2'}}},
+                {'metadata': {'name': 'placeholder-gone', 'annotations': {'kube-aws-autoscaler/asg': 'a3'}}}]
+    api.get.return_value.json.return_value = {'items': existing}
+    pod = {'metadata': {'name': 'placeholder-new', 'annotations': {'kube-aws-autoscaler/asg': 'a1', 'kube-aws-autoscaler/zone': 'z1'}},
+           'spec': {'containers': [{'resources': {'requests': {'cpu': '100m'}}}]}}
+    reconcile_placeholder_pods(api, 'ns', {'placeholder-keep': {}, 'placeholder-new': pod}, {'a1'}, {'a1', 'a2'})
+    api.get.assert_called_once_with(url='pods', namespace='ns', params={'labelSelector': 'kube-aws-autoscaler/placeholder'})
+    assert [c[1]['url'] for c in api.delete.call_args_list] == ['pods/placeholder-gone', 'pods/placeholder-old']
+    api.post.assert_called_once_with(url='pods', namespace='ns', data=json.dumps(pod))
+
+    api.reset_mock()
+    reconcile_placeholder_pods(api, 'ns', {'placeholder-new': pod}, {'a1'}, {'a1', 'a2'}, dry_run=True)
+    api.delete.assert_not_called()
+    api.post.assert_not_called()
+
+
+def test_autoscale_decision(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.DECISIONS', collections.deque(maxlen=10))
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_kube_api', MagicMock())
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_nodes', MagicMock(return_value={'n1': {'region': 'eu-north-1'}}))
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_nodes_by_asg_zone',
+                        MagicMock(return_value={('a1', 'z1'): [{'name': 'n1', 'region': 'eu-north-1'}]}))
+    monkeypatch.setattr('pykube.Pod.objects', MagicMock(return_value=[]))
+    boto3_client = MagicMock()
+    boto3_client.return_value.describe_auto_scaling_groups.side_effect = Exception('AWS is down')
+    monkeypatch.setattr('boto3.client', boto3_client)
+    monkeypatch.setattr('kube_aws_autoscaler.main.AUTOSCALING_CLIENTS', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.calculate_required_auto_scaling_group_sizes', MagicMock(return_value={'a1': 1}))
+    with pytest.raises(Exception):
+        autoscale({}, {}, 1, 0.0)
+    decision, = kube_aws_autoscaler.main.DECISIONS
+    assert decision['error'] == 'AWS is down'
+
+
+def test_what_if_endpoint(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.CLUSTER_STATE', {})
+    flask = get_app().test_client()
+    assert flask.post('/what-if', json=[{}]).status_code == 503
+
+    node = {'name': 'n1', 'allocatable': {'cpu': 1000, 'memory': 1024**3, 'pods': 10}, 'unschedulable': False, 'master': False}
+    monkeypatch.setattr('kube_aws_autoscaler.main.CLUSTER_STATE', {'nodes_by_asg_zone': {('a1', 'z1'): [node]},
+                                                                   'usage_by_asg_zone': {}})
+    response = flask.post('/what-if', json=[{'buffer-spare-nodes': 0}, {'buffer-spare-nodes': 3}])
+    assert response.status_code == 200
+    assert [result['asg_sizes'] for result in response.get_json()] == [{'a1': 1}, {'a1': 4}]
+    assert flask.post('/what-if', json={}).status_code == 400
+    assert flask.post('/what-if', json=[{'buffer-cpu-fixed': 'foo'}]).status_code == 400
+
+
+def test_main_what_if(monkeypatch, tmpdir, capsys):
+    node = {'name': 'n1', 'region': 'eu-central-1', 'instance_type': 'm5.large', 'allocatable': {'cpu': 1000, 'memory': 1024**3, 'pods': 10},
+            'unschedulable': False, 'master': False}
+    client = MagicMock()
+    client.describe_auto_scaling_groups.return_value = {'AutoScalingGroups': [
+        {'AutoScalingGroupName': 'a1', 'AvailabilityZones': ['z1']},
+        {'AutoScalingGroupName': 'spot', 'AvailabilityZones': ['z1'],
+         'MixedInstancesPolicy': {'LaunchTemplate': {'Overrides': [{'InstanceType': 'm5.large'}]}}}]}
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_kube_api', MagicMock())
+    monkeypatch.setattr('kube_aws_autoscaler.main.get_cluster_state',
+                        MagicMock(return_value=({'eu-central-1': client}, {('a1', 'z1'): [node]}, {}, [])))
+    monkeypatch.setattr('kube_aws_autoscaler.main.discover_auto_scaling_groups', MagicMock(return_value={'spot': 'eu-central-1'}))
+    monkeypatch.setattr('kube_aws_autoscaler.main.ASG_CACHE', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.INSTANCE_TYPE_ALLOCATABLE', {})
+    monkeypatch.setattr('kube_aws_autoscaler.main.ASG_INSTANCE_TYPES', collections.defaultdict(set))
+    autoscale = MagicMock()
+    monkeypatch.setattr('kube_aws_autoscaler.main.autoscale', autoscale)
+    path = tmpdir.join('configs.json')
+    path.write(json.dumps([{'buffer-spare-nodes': 2}]))
+    monkeypatch.setattr('sys.argv', ['foo', '--what-if', str(path), '--discover-asg-tag', 'my-tag'])
+    main()
+    autoscale.assert_not_called()
+    # buffer fits on one node plus 2 spare nodes, the discovered ASG without nodes stays empty
+    assert json.loads(capsys.readouterr().out)[0]['asg_sizes'] == {'a1': 3, 'spot': 0}
+
+
+def test_profile_endpoint(monkeypatch):
+    monkeypatch.setattr('kube_aws_autoscaler.main.PROFILE', {'iterations': 0, 'directory': '/tmp'})
+    flask = get_app().test_client()
+    response = flask.post('/profile?iterations=3')
+    assert response.status_code == 200
+    assert response.get_json() == {'iterations': 3, 'directory': '/tmp'}
+    assert kube_aws_autoscaler.main.PROFILE['iterations'] == 3
+
+
 def test_endpoint_healthy_state(monkeypatch):
     kube_aws_autoscaler.main.Healthy = False
     autoscale = MagicMock()
@@ -520,3 +1389,10 @@ def test_endpoint_healthy_state(monkeypatch):
     monkeypatch.setattr('sys.argv', ['foo', '--once', '--dry-run'])
     main()
     assert kube_aws_autoscaler.main.Healthy == True
+
+
+def test_startup_does_not_import_heavy_dependencies():
+    # import time itself is reported by tests/fake_apis.py, asserting wall-clock time here would be flaky
+    code = 'import sys; import kube_aws_autoscaler.main; print(" ".join(sorted(sys.modules)))'
+    modules = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True)
+    assert not {'boto3', 'botocore', 'pykube', 'flask'} & set(modules.split())